@@ -0,0 +1,220 @@
+#
+# bootstrap.py
+#
+# Per-container setup shared by the final-project-*.py handlers:
+# the config file, the S3 session and bucket, AWS clients and the
+# database shards (whose connection pools live in datatier). Each
+# is created on first use and kept in this module, so a warm
+# invocation skips the setup, and a handler only pays for what it
+# uses (e.g. the playlist never sets up S3):
+#
+#   configur = bootstrap.get_config()
+#   bucket = bootstrap.get_bucket()
+#   shards = bootstrap.get_shards()
+#   session = bootstrap.get_http_session()
+#
+# A failed setup is not remembered; the next call tries again.
+# boto3 and requests are imported on first use too, boto3 is the
+# slowest import of the handlers (see import_budget.py).
+#
+
+import datatier
+import os
+import threading
+
+from configparser import ConfigParser
+
+
+CONFIG_FILE = 'musicapp-config.ini'
+S3_PROFILE = 's3readwrite'
+
+#
+# HTTP connections kept open for reuse, to the Inference API and
+# Spotify: # of hosts, and # of connections per host (the text
+# analysis runs up to 4 uploads x 4 chunks at once, see s3events.py
+# and emotion.py):
+#
+HTTP_POOL_CONNECTIONS = 4
+HTTP_POOL_MAXSIZE = 16
+
+#
+# users are never modified once created, so a user lookup that
+# finds the user is served from datatier's query cache this long
+# (see user_cache_ttl):
+#
+USER_CACHE_TTL = 300
+
+_lock = threading.RLock()  # re-entrant: get_bucket() calls get_config()
+
+_config = None
+_bucket = None
+_s3_client = None
+_shards = None
+_clients = {}
+_http_session = None
+
+
+###################################################################
+#
+# get_config:
+#
+# Returns the parsed config file; AWS credentials are read from
+# the same file.
+#
+def get_config():
+  global _config
+
+  with _lock:
+    if _config is None:
+      os.environ['AWS_SHARED_CREDENTIALS_FILE'] = CONFIG_FILE
+
+      configur = ConfigParser()
+      configur.read(CONFIG_FILE)
+
+      _config = configur
+
+    return _config
+
+
+###################################################################
+#
+# get_bucket:
+#
+# Returns the S3 bucket object of the bucket named in the config
+# file, accessed with the s3readwrite profile (also the default
+# session for other AWS clients). An optional endpoint_url in the
+# s3 section points S3 access at an S3-compatible stand-in, e.g.
+# MinIO or moto in server mode, for local testing.
+#
+def get_bucket():
+  global _bucket
+
+  with _lock:
+    if _bucket is None:
+      import boto3
+
+      configur = get_config()
+
+      boto3.setup_default_session(profile_name=S3_PROFILE)
+
+      bucketname = configur.get('s3', 'bucket_name')
+
+      s3 = boto3.resource('s3', endpoint_url=configur.get('s3', 'endpoint_url', fallback=None))
+      _bucket = s3.Bucket(bucketname)
+
+    return _bucket
+
+
+###################################################################
+#
+# get_s3_client:
+#
+# Returns a boto3 S3 client for the bucket's region and endpoint,
+# e.g. to generate presigned URLs. It signs with SigV4 (boto3 may
+# otherwise presign SigV2 URLs, which S3 rejects for new buckets),
+# at the bucket's regional endpoint, e.g.
+# https://<bucket>.s3.us-east-1.amazonaws.com, not the global one;
+# a stand-in at endpoint_url is addressed by path instead.
+#
+def get_s3_client():
+  global _s3_client
+
+  with _lock:
+    if _s3_client is None:
+      from botocore.config import Config
+
+      configur = get_config()
+
+      endpoint_url = configur.get('s3', 'endpoint_url', fallback=None)
+
+      config = Config(signature_version='s3v4',
+                      s3={'addressing_style': 'virtual' if endpoint_url is None else 'path',
+                          'us_east_1_regional_endpoint': 'regional'})
+
+      _s3_client = get_client('s3',
+                              region_name=configur.get('s3', 'region_name', fallback=None),
+                              endpoint_url=endpoint_url,
+                              config=config)
+
+    return _s3_client
+
+
+###################################################################
+#
+# get_client:
+#
+# Returns a boto3 client for the given service, e.g.
+# get_client('rekognition', region_name=...), one per service and
+# settings.
+#
+def get_client(service, **kwargs):
+  key = (service, tuple(sorted(kwargs.items())))
+
+  with _lock:
+    client = _clients.get(key)
+    if client is None:
+      get_bucket()  # sets up the default session
+
+      import boto3
+      client = boto3.client(service, **kwargs)
+      _clients[key] = client
+
+    return client
+
+
+###################################################################
+#
+# get_http_session:
+#
+# Returns the requests.Session for outbound HTTP calls. Its
+# connections are kept alive and pooled, up to HTTP_POOL_MAXSIZE per
+# host, so a call reuses an open TCP+TLS connection (across threads,
+# and across warm invocations) instead of a new handshake each time.
+# Like a bare requests call, it accepts gzip-compressed responses.
+#
+def get_http_session():
+  global _http_session
+
+  with _lock:
+    if _http_session is None:
+      import requests
+      from requests.adapters import HTTPAdapter
+
+      adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+
+      session = requests.Session()
+      session.mount("https://", adapter)
+      session.mount("http://", adapter)
+
+      _http_session = session
+
+    return _http_session
+
+
+###################################################################
+#
+# get_shards:
+#
+# Returns the datatier.ShardMap of the RDS sections of the config
+# file: one or more shards, each with optional read replicas.
+#
+def get_shards():
+  global _shards
+
+  with _lock:
+    if _shards is None:
+      _shards = datatier.ShardMap.from_config(get_config())
+
+    return _shards
+
+
+###################################################################
+#
+# user_cache_ttl:
+#
+# The ttl= for datatier's retrieve functions of a user lookup:
+#
+#   datatier.retrieve_one_row(dbConn, sql, [userid], ttl=bootstrap.user_cache_ttl)
+#
+def user_cache_ttl(row):
+  return USER_CACHE_TTL if row != () else 0
@@ -0,0 +1,90 @@
+--
+-- SQLite translation of create-db.sql, for the embedded
+-- datatier backend (endpoint = sqlite:<path>). Run with
+-- datatier.init_sqlite_db(path).
+--
+-- Differences from MySQL:
+--   * INTEGER PRIMARY KEY AUTOINCREMENT instead of AUTO_INCREMENT,
+--     with starting values set through sqlite_sequence
+--   * no database or user accounts, access is via the file
+--
+
+
+PRAGMA foreign_keys = OFF;
+
+DROP TABLE IF EXISTS schema_migrations;  -- see migrate.py
+DROP TABLE IF EXISTS user_tracks_archive;  -- created by migrations
+DROP TABLE IF EXISTS user_tracks;
+DROP TABLE IF EXISTS tracks;
+DROP TABLE IF EXISTS songs_archive;     -- created by migrations
+DROP TABLE IF EXISTS jobs_archive;
+DROP TABLE IF EXISTS songs;
+DROP TABLE IF EXISTS jobs;
+DROP TABLE IF EXISTS users;
+
+PRAGMA foreign_keys = ON;
+
+
+CREATE TABLE users
+(
+    userid       integer not null PRIMARY KEY AUTOINCREMENT,
+    username     varchar(64) not null,
+    pwdhash      varchar(256) not null,
+    UNIQUE       (username)
+);
+
+
+CREATE TABLE jobs
+(
+    jobid             integer not null PRIMARY KEY AUTOINCREMENT,
+    userid            int not null,
+    status            varchar(256) not null,  -- uploaded, completed, error, processing...
+    originaldatafile  varchar(256) not null,  -- original TXT filename from user
+    datafilekey       varchar(256) not null,  -- TXT filename in S3 (bucketkey)
+    valence           float not null default 0.0,  -- computed valence
+    energy            float not null default 0.0,  -- computed energy
+    FOREIGN KEY (userid) REFERENCES users(userid),
+    UNIQUE      (datafilekey)
+);
+
+
+CREATE TABLE songs
+(
+    songid       integer not null PRIMARY KEY AUTOINCREMENT,
+    userid       int not null,
+    jobid        int not null,
+    songname     varchar(256) not null,
+    songartist   varchar(256) not null,
+    FOREIGN KEY  (userid) REFERENCES users(userid),
+    FOREIGN KEY  (jobid) REFERENCES jobs(jobid),
+    UNIQUE       (songname)
+);
+
+
+--
+-- starting values, same as MySQL (next id = seq + 1):
+--
+DELETE FROM sqlite_sequence WHERE name IN ('users', 'jobs', 'songs');
+
+INSERT INTO sqlite_sequence(name, seq) VALUES('users', 80000);
+INSERT INTO sqlite_sequence(name, seq) VALUES('jobs', 1000);
+
+
+--
+-- Insert some users to start with:
+--
+INSERT INTO users(username, pwdhash)  -- pwd = abc123!!
+            values('p_sarkar', '$2y$10$/8B5evVyaHF.hxVx0i6dUe2JpW89EZno/VISnsiD1xSh6ZQsNMtXK');
+
+
+INSERT INTO users(username, pwdhash)  -- pwd = abc456!!
+            values('e_ricci', '$2y$10$F.FBSF4zlas/RpHAxqsuF.YbryKNr53AcKBR3CbP2KsgZyMxOI2z2');
+
+
+INSERT INTO users(username, pwdhash)  -- pwd = abc789!!
+            values('l_chen', '$2y$10$GmIzRsGKP7bd9MqH.mErmuKvZQ013kPfkKbeUAHxar5bn1vu9.sdK');
+
+
+--
+-- done
+--
@@ -4,6 +4,12 @@ CREATE DATABASE IF NOT EXISTS musicapp;
 USE musicapp;
 
 
+DROP TABLE IF EXISTS schema_migrations;  -- see migrate.py
+DROP TABLE IF EXISTS user_tracks_archive;  -- created by migrations
+DROP TABLE IF EXISTS user_tracks;
+DROP TABLE IF EXISTS tracks;
+DROP TABLE IF EXISTS songs_archive;     -- created by migrations
+DROP TABLE IF EXISTS jobs_archive;
 DROP TABLE IF EXISTS songs;
 DROP TABLE IF EXISTS jobs;
 DROP TABLE IF EXISTS users;
@@ -93,7 +99,7 @@ CREATE USER 'musicapp-read-write' IDENTIFIED BY 'def456!!';
 
 GRANT SELECT, SHOW VIEW ON musicapp.* 
       TO 'musicapp-read-only';
-GRANT SELECT, SHOW VIEW, INSERT, UPDATE, DELETE, DROP, CREATE, ALTER ON musicapp.* 
+GRANT SELECT, SHOW VIEW, INSERT, UPDATE, DELETE, DROP, CREATE, ALTER, INDEX ON musicapp.* 
       TO 'musicapp-read-write';
       
 FLUSH PRIVILEGES;
@@ -1,31 +1,618 @@
 #
 # datatier.py
 #
-# Executes SQL queries against a MySQL database.
+# Executes SQL queries against a MySQL database, or against an
+# embedded SQLite database (see "SQLite backend" below).
 #
 # Original author:
 #   Prof. Joe Hummel
 #   Northwestern University
 #
 
+import itertools
+import json
+import logging
+import lrucache
 import pymysql
+import re
+import sqlite3
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+
+
+###################################################################
+#
+# connection pool settings:
+#
+# Connections are kept in a module-level pool per database, so
+# warm invocations of a lambda function reuse an open connection
+# instead of paying for a new TCP+TLS+MySQL handshake.
+#
+#   POOL_MAX_SIZE: max # of open connections per database
+#   POOL_MAX_IDLE: seconds a connection may sit idle in the pool
+#     before it is closed rather than reused
+#   POOL_PING_INTERVAL: a connection idle longer than this is
+#     pinged (and reconnected if stale) before it is handed out
+#   POOL_WAIT_TIMEOUT: seconds to wait for a connection when all
+#     POOL_MAX_SIZE connections are in use
+#
+POOL_MAX_SIZE = 4
+POOL_MAX_IDLE = 300
+POOL_PING_INTERVAL = 30
+POOL_WAIT_TIMEOUT = 10
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+###################################################################
+#
+# PooledConnection:
+#
+# Thin wrapper around a connection checked out of a pool. It
+# behaves like the underlying connection, except that close()
+# returns the connection to the pool instead of closing it.
+#
+class PooledConnection:
+
+  def __init__(self, pool, conn):
+    self._pool = pool
+    self._conn = conn
+
+  def __getattr__(self, name):
+    conn = self.__dict__.get("_conn")
+    if conn is None:
+      raise Exception("datatier: connection has already been returned to the pool")
+    return getattr(conn, name)
+
+  def close(self):
+    conn = self._conn
+    if conn is not None:
+      self._conn = None
+      self._pool.release(conn)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+    return False
+
+
+###################################################################
+#
+# ConnectionPool:
+#
+# A bounded pool of connections to one database. connect is a
+# function that opens a new connection. Idle connections are
+# reused most-recently-used first; connections idle longer than
+# max_idle are closed, and connections idle longer than
+# ping_interval are health-checked before reuse.
+#
+class ConnectionPool:
+
+  def __init__(self, connect,
+               max_size=None, max_idle=None,
+               ping_interval=None, wait_timeout=None):
+    self._connect = connect
+    self.max_size = POOL_MAX_SIZE if max_size is None else max_size
+    self.max_idle = POOL_MAX_IDLE if max_idle is None else max_idle
+    self.ping_interval = POOL_PING_INTERVAL if ping_interval is None else ping_interval
+    self.wait_timeout = POOL_WAIT_TIMEOUT if wait_timeout is None else wait_timeout
+
+    self._idle = []  # list of (connection, time returned to pool)
+    self._size = 0   # open connections, idle or checked out
+    self._cond = threading.Condition()
+
+  def acquire(self):
+    """
+    Returns a PooledConnection, reusing an idle connection if
+    possible and opening a new one otherwise
+    """
+    deadline = time.monotonic() + self.wait_timeout
+
+    while True:
+      conn = None
+      idle_for = 0
+
+      with self._cond:
+        if self._idle:
+          (conn, last_used) = self._idle.pop()
+          idle_for = time.monotonic() - last_used
+        elif self._size < self.max_size:
+          self._size += 1
+        else:
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            raise Exception("datatier: connection pool exhausted (max_size=" + str(self.max_size) + ")")
+          self._cond.wait(remaining)
+          continue
+
+      if conn is None:
+        #
+        # we reserved a slot above, open a new connection:
+        #
+        try:
+          conn = self._connect()
+        except Exception:
+          self._discard(None)
+          raise
+        return PooledConnection(self, conn)
+
+      if idle_for > self.max_idle:
+        self._discard(conn)
+        continue
+
+      if idle_for > self.ping_interval and not self._is_healthy(conn):
+        self._discard(conn)
+        continue
+
+      return PooledConnection(self, conn)
+
+  def release(self, conn):
+    """
+    Returns a connection to the pool; connections that have
+    been closed are dropped
+    """
+    if not getattr(conn, "open", True):
+      self._discard(conn)
+      return
+
+    with self._cond:
+      self._idle.append((conn, time.monotonic()))
+      self._cond.notify()
+
+  def close(self):
+    """
+    Closes all idle connections in the pool
+    """
+    with self._cond:
+      idle = self._idle
+      self._idle = []
+
+    for (conn, _) in idle:
+      self._discard(conn)
+
+  def _is_healthy(self, conn):
+    try:
+      conn.ping(reconnect=True)  # reconnects if the server dropped us
+      return True
+    except Exception:
+      return False
+
+  def _discard(self, conn):
+    if conn is not None:
+      try:
+        conn.close()
+      except Exception:
+        pass
+
+    with self._cond:
+      self._size -= 1
+      self._cond.notify()
+
+
+###################################################################
+#
+# SQLite backend:
+#
+# If the endpoint passed to get_dbConn has the form
+# "sqlite:<path>", e.g. "sqlite:/tmp/musicapp.db", connections
+# are to an embedded SQLite database file instead of a MySQL
+# server (port, user name, password and database name are then
+# ignored). The same retrieve_* / perform_action API works on
+# both: SQLiteConnection and SQLiteCursor mimic the parts of
+# pymysql we use, and translate pymysql's %s paramstyle and the
+# few MySQL-isms the handlers use (LAST_INSERT_ID(), NOW(),
+# SELECT ... FOR UPDATE / FOR SHARE, INSERT IGNORE) into SQLite.
+# Every connection runs in WAL mode, so readers never block the
+# writer. Create the database with init_sqlite_db().
+#
+SQLITE_PREFIX = "sqlite:"
+SQLITE_SCHEMA_FILE = "create-db-sqlite.sql"
+SQLITE_BUSY_TIMEOUT = 5  # seconds to wait on a locked database
+
+_SQLITE_FUNCTIONS = [
+  (re.compile(r"\bLAST_INSERT_ID\s*\(\s*\)", re.IGNORECASE), "last_insert_rowid()"),
+  (re.compile(r"\bNOW\s*\(\s*\)", re.IGNORECASE), "CURRENT_TIMESTAMP"),
+  #
+  # SQLite has no row locks; begin() takes the database's write
+  # lock instead, which covers whatever FOR UPDATE would lock:
+  #
+  (re.compile(r"\s+FOR\s+(UPDATE|SHARE)\b", re.IGNORECASE), ""),
+  (re.compile(r"\bINSERT\s+IGNORE\b", re.IGNORECASE), "INSERT OR IGNORE"),
+]
+
+_sqlite_translations = {}
+
+
+def _translate_sql(sql):
+  """
+  Translates a pymysql-style query into SQLite: %s => ?, %% => %,
+  and MySQL functions into their SQLite equivalents. Quoted
+  literals are left untouched.
+  """
+  translated = _sqlite_translations.get(sql)
+  if translated is not None:
+    return translated
+
+  pieces = []
+  i = 0
+  n = len(sql)
+
+  while i < n:
+    c = sql[i]
+    if c in "'\"`":
+      #
+      # copy quoted literal / identifier as-is:
+      #
+      j = i + 1
+      while j < n and sql[j] != c:
+        j += 2 if sql[j] == "\\" else 1
+      pieces.append(sql[i:j + 1])
+      i = j + 1
+    elif sql.startswith("%s", i):
+      pieces.append("?")
+      i += 2
+    elif sql.startswith("%%", i):
+      pieces.append("%")
+      i += 2
+    else:
+      j = i
+      while j < n and sql[j] not in "'\"`%":
+        j += 1
+      if j == i:  # lone %
+        j += 1
+      chunk = sql[i:j]
+      for (pattern, replacement) in _SQLITE_FUNCTIONS:
+        chunk = pattern.sub(replacement, chunk)
+      pieces.append(chunk)
+      i = j
+
+  translated = "".join(pieces)
+  _sqlite_translations[sql] = translated
+  return translated
+
+
+class SQLiteCursor:
+
+  def __init__(self, conn):
+    self._cursor = conn.cursor()
+
+  @property
+  def rowcount(self):
+    return self._cursor.rowcount
+
+  @property
+  def lastrowid(self):
+    return self._cursor.lastrowid
+
+  def execute(self, sql, parameters=None):
+    self._cursor.execute(_translate_sql(sql), tuple(parameters or ()))
+    return self._cursor.rowcount
+
+  def executemany(self, sql, parameters_list):
+    self._cursor.executemany(_translate_sql(sql), [tuple(p) for p in parameters_list])
+    return self._cursor.rowcount
+
+  def fetchone(self):
+    return self._cursor.fetchone()
+
+  def fetchmany(self, size):
+    return tuple(self._cursor.fetchmany(size))
+
+  def fetchall(self):
+    return tuple(self._cursor.fetchall())
+
+  def close(self):
+    self._cursor.close()
+
+
+class SQLiteConnection:
+
+  def __init__(self, path):
+    self.host = SQLITE_PREFIX + path
+    self.port = None
+    self.db = path
+    self.open = True
+
+    #
+    # isolation_level=None => autocommit, like our pymysql
+    # connections; begin() starts an explicit transaction:
+    #
+    self._conn = sqlite3.connect(path,
+                                 timeout=SQLITE_BUSY_TIMEOUT,
+                                 isolation_level=None,
+                                 check_same_thread=False)
+    self._conn.execute("PRAGMA journal_mode = WAL")
+    self._conn.execute("PRAGMA synchronous = NORMAL")  # safe with WAL
+    self._conn.execute("PRAGMA foreign_keys = ON")
+
+  def cursor(self, cursorclass=None):
+    # SQLite cursors already stream rows, so cursorclass
+    # (e.g. pymysql.cursors.SSCursor) is ignored:
+    return SQLiteCursor(self._conn)
+
+  def begin(self):
+    # IMMEDIATE: take the write lock now, so a transaction that
+    # reads before it writes cannot fail to upgrade its lock:
+    self._conn.execute("BEGIN IMMEDIATE")
+
+  def commit(self):
+    if self._conn.in_transaction:
+      self._conn.execute("COMMIT")
+
+  def rollback(self):
+    if self._conn.in_transaction:
+      self._conn.execute("ROLLBACK")
+
+  def get_autocommit(self):
+    return True
+
+  def ping(self, reconnect=True):
+    self._conn.execute("SELECT 1")
+
+  def close(self):
+    self.open = False
+    self._conn.close()
+
+
+###################################################################
+#
+# init_sqlite_db:
+#
+# Creates (or re-creates) an embedded SQLite database from the
+# SQLite translation of create-db.sql.
+#
+def init_sqlite_db(path, schema_file=SQLITE_SCHEMA_FILE):
+  """
+  Creates the MusicApp tables in a SQLite database file, dropping
+  any existing tables first
+
+  Parameters
+  __________
+  path : SQLite database file (string),
+  schema_file: optional schema script to run
+
+  Returns
+  _______
+  nothing
+  """
+  with open(schema_file, "r") as f:
+    script = f.read()
+
+  conn = sqlite3.connect(path, isolation_level=None)
+
+  try:
+    conn.execute("PRAGMA journal_mode = WAL")  # persistent for the file
+    conn.executescript(script)
+
+  except Exception as err:
+    print("datatier.init_sqlite_db() failed:")
+    print(str(err))
+    raise
+
+  finally:
+    conn.close()
+
+
+###################################################################
+#
+# _get_pool:
+#
+# Returns the module-level pool for the given database, creating
+# it on first use.
+#
+def _get_pool(endpoint, portnum, username, pwd, dbname):
+  key = (endpoint, portnum, username, pwd, dbname)
+
+  with _pools_lock:
+    pool = _pools.get(key)
+    if pool is None:
+      def connect():
+        if endpoint.startswith(SQLITE_PREFIX):
+          return SQLiteConnection(endpoint[len(SQLITE_PREFIX):])
+        #
+        # autocommit so each SELECT on a reused connection sees
+        # current data rather than an old transaction snapshot:
+        #
+        return pymysql.connect(host=endpoint,
+                               port=portnum,
+                               user=username,
+                               passwd=pwd,
+                               database=dbname,
+                               autocommit=True)
+
+      pool = ConnectionPool(connect)
+      _pools[key] = pool
+
+    return pool
+
+
+###################################################################
+#
+# close_pools:
+#
+# Closes every idle pooled connection, e.g. before shutdown.
+#
+def close_pools():
+  with _pools_lock:
+    pools = list(_pools.values())
+
+  for pool in pools:
+    pool.close()
+
+
+###################################################################
+#
+# query statistics:
+#
+# Every query run through this module is timed. Timings are
+# grouped by normalized SQL (whitespace collapsed, literals and
+# parameters replaced by ?), and for each group we keep the
+# count, errors, total rows returned/modified, max time, and a
+# window of the most recent STATS_WINDOW timings from which p50
+# and p95 are computed. A query taking at least
+# SLOW_QUERY_THRESHOLD seconds is logged as a structured (JSON)
+# record on the "datatier" logger; set the threshold to None to
+# disable slow-query logging.
+#
+SLOW_QUERY_THRESHOLD = 0.5
+STATS_WINDOW = 1000
+
+logger = logging.getLogger("datatier")
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+_RE_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_RE_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_RE_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+
+class QueryStats:
+
+  def __init__(self):
+    self.count = 0
+    self.errors = 0
+    self.rows = 0
+    self.total_time = 0.0
+    self.max_time = 0.0
+    self.window = deque(maxlen=STATS_WINDOW)  # most recent timings
+
+  def add(self, elapsed, nrows, ok):
+    self.count += 1
+    self.rows += nrows
+    self.total_time += elapsed
+    self.max_time = max(self.max_time, elapsed)
+    if not ok:
+      self.errors += 1
+
+    self.window.append(elapsed)
+
+  def summary(self):
+    timings = sorted(self.window)
+
+    def percentile(p):
+      if len(timings) == 0:
+        return 0.0
+      return timings[min(len(timings) - 1, int(p * len(timings)))]
+
+    return {
+      "count": self.count,
+      "errors": self.errors,
+      "rows": self.rows,
+      "avg_ms": round(1000 * self.total_time / self.count, 3) if self.count > 0 else 0.0,
+      "p50_ms": round(1000 * percentile(0.50), 3),
+      "p95_ms": round(1000 * percentile(0.95), 3),
+      "max_ms": round(1000 * self.max_time, 3)
+    }
+
+
+###################################################################
+#
+# normalize_sql:
+#
+# Returns the key under which a query's timings are grouped.
+#
+def normalize_sql(sql):
+  """
+  Normalizes an SQL query so that queries differing only in
+  whitespace, case, literals or parameter values compare equal
+
+  Parameters
+  __________
+  sql : the SQL query
+
+  Returns
+  _______
+  the normalized SQL (string)
+  """
+  key = _RE_STRING.sub("?", sql)
+  key = key.replace("%s", "?")
+  key = _RE_NUMBER.sub("?", key)
+  key = " ".join(key.split()).lower().rstrip("; ")
+  key = _RE_LIST.sub("(...)", key)  # IN (?, ?, ?) => IN (...)
+  return key
+
+
+def _record_query(funcname, sql, start, nrows, ok):
+  elapsed = time.perf_counter() - start
+  key = normalize_sql(sql)
+  nrows = max(nrows, 0)  # rowcount is -1 for e.g. DDL
+
+  with _stats_lock:
+    stats = _stats.get(key)
+    if stats is None:
+      stats = QueryStats()
+      _stats[key] = stats
+    stats.add(elapsed, nrows, ok)
+
+  if SLOW_QUERY_THRESHOLD is not None and elapsed >= SLOW_QUERY_THRESHOLD:
+    record = {
+      "event": "slow_query",
+      "function": funcname,
+      "sql": key,
+      "elapsed_ms": round(1000 * elapsed, 3),
+      "rows": nrows,
+      "ok": ok
+    }
+    logger.warning(json.dumps(record), extra={"query": record})
+
+
+###################################################################
+#
+# get_query_stats:
+#
+# Returns a snapshot of the timing statistics collected so far.
+#
+def get_query_stats():
+  """
+  Returns timing statistics for every query executed so far
+
+  Returns
+  _______
+  dictionary mapping normalized SQL to a dictionary with count,
+  errors, rows, avg_ms, p50_ms, p95_ms and max_ms
+  """
+  with _stats_lock:
+    return {key: stats.summary() for (key, stats) in _stats.items()}
+
+
+###################################################################
+#
+# reset_query_stats:
+#
+# Discards all timing statistics collected so far.
+#
+def reset_query_stats():
+  with _stats_lock:
+    _stats.clear()
 
 
 ###################################################################
 #
 # get_dbConn:
 #
-# Opens and returns a connection object for interacting with a
-# MySQL database.
+# Returns a connection object for interacting with a MySQL
+# database, taken from a module-level pool. Call close() on
+# the connection to return it to the pool. An endpoint of the
+# form "sqlite:<path>" connects to an embedded SQLite database
+# instead.
 #
 def get_dbConn(endpoint, portnum, username, pwd, dbname):
   """
-  Opens and returns a connection object for interacting 
-  with a MySQL database
+  Returns a pooled connection object for interacting 
+  with a MySQL database; an idle connection is reused
+  if available, otherwise a new one is opened
 
   Parameters
   ----------
-  endpoint : machine name or IP address of server (string),
+  endpoint : machine name or IP address of server, or
+    "sqlite:<path>" for a SQLite database file (string),
   portnum : server port # (integer),
   username : user name for login (string),
   pwd : user password for login (string),
@@ -33,16 +620,12 @@ def get_dbConn(endpoint, portnum, username, pwd, dbname):
 
   Returns
   -------
-  a connection object
+  a connection object; close() returns it to the pool
   """
   try:
-    dbConn = pymysql.connect(host=endpoint,
-                             port=portnum,
-                             user=username,
-                             passwd=pwd,
-                             database=dbname)
+    pool = _get_pool(endpoint, portnum, username, pwd, dbname)
 
-    return dbConn
+    return pool.acquire()
 
   except Exception as err:
     print("datatier.get_dbConn() failed:")
@@ -50,6 +633,339 @@ def get_dbConn(endpoint, portnum, username, pwd, dbname):
     raise
 
 
+###################################################################
+#
+# read/write splitting:
+#
+# get_routed_dbConn returns a RoutedConnection, which can be
+# passed to every function in this module in place of a plain
+# connection. Queries (retrieve_*, iter_rows) are sent to a read
+# endpoint (replica), picked round-robin, while actions
+# (perform_action*, transaction) go to the writer. After the
+# first action the connection is pinned to the writer for the
+# rest of its life, so a request always reads its own writes.
+# Open one RoutedConnection per request and close() it at the
+# end. If a replica cannot be reached, or there are no read
+# endpoints, reads go to the writer.
+#
+_read_counter = itertools.count()
+
+
+class RoutedConnection:
+
+  def __init__(self, writer, readers):
+    self._writer_config = writer    # (endpoint, portnum, username, pwd, dbname)
+    self._reader_configs = readers  # list of the same
+    self._writer = None
+    self._reader = None
+    self.pinned = False
+
+    #
+    # identifies the database for the query cache; every
+    # replica holds the same data as the writer:
+    #
+    self.host = writer[0]
+    self.port = writer[1]
+    self.db = writer[4]
+
+  def writer(self):
+    """
+    Returns the writer connection, and pins reads to it
+    """
+    self.pinned = True
+    return self._writer_conn()
+
+  def reader(self):
+    """
+    Returns a connection to a read endpoint, or the writer if
+    pinned or no read endpoint is available
+    """
+    if self.pinned or len(self._reader_configs) == 0:
+      return self._writer_conn()
+
+    if self._reader is None:
+      n = len(self._reader_configs)
+      first = next(_read_counter)
+
+      for i in range(n):
+        config = self._reader_configs[(first + i) % n]
+        try:
+          self._reader = get_dbConn(*config)
+          break
+        except Exception:
+          print("datatier: read endpoint", config[0], "unavailable")
+
+      if self._reader is None:  # no replica reachable
+        return self._writer_conn()
+
+    return self._reader
+
+  def _writer_conn(self):
+    if self._writer is None:
+      self._writer = get_dbConn(*self._writer_config)
+    return self._writer
+
+  def close(self):
+    for conn in [self._reader, self._writer]:
+      if conn is not None:
+        conn.close()
+    self._reader = None
+    self._writer = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+    return False
+
+
+def _read_conn(dbConn):
+  if isinstance(dbConn, RoutedConnection):
+    return dbConn.reader()
+  return dbConn
+
+
+def _write_conn(dbConn):
+  if isinstance(dbConn, RoutedConnection):
+    return dbConn.writer()
+  return dbConn
+
+
+###################################################################
+#
+# get_routed_dbConn:
+#
+# Returns a RoutedConnection that reads from the given read
+# endpoints and writes to the given (writer) endpoint.
+#
+def get_routed_dbConn(endpoint, portnum, username, pwd, dbname,
+                      read_endpoints=[], read_username=None, read_pwd=None):
+  """
+  Returns a connection object that routes queries to read
+  endpoints and actions to the writer; connections to the
+  individual servers are opened on first use, from the pools
+
+  Parameters
+  ----------
+  endpoint : machine name or IP address of writer (string),
+  portnum : server port # (integer),
+  username : user name for writer login (string),
+  pwd : user password for writer login (string),
+  dbname : database name (string),
+  read_endpoints : optional list of read endpoints, or a string
+    of comma-separated endpoints,
+  read_username : optional user name for read endpoints (e.g.
+    musicapp-read-only), defaults to username,
+  read_pwd : optional user password for read endpoints, defaults
+    to pwd
+
+  Returns
+  -------
+  a RoutedConnection; close() returns its connections to the pools
+  """
+  if isinstance(read_endpoints, str):
+    read_endpoints = [e.strip() for e in read_endpoints.split(",")]
+
+  if read_username is None:
+    read_username = username
+  if read_pwd is None:
+    read_pwd = pwd
+
+  writer = (endpoint, portnum, username, pwd, dbname)
+  readers = [(e, portnum, read_username, read_pwd, dbname) for e in read_endpoints if e != ""]
+
+  return RoutedConnection(writer, readers)
+
+
+###################################################################
+#
+# sharding:
+#
+# Users, and their jobs and songs, can be spread over several
+# databases ("shards"), each with the full schema. A ShardMap
+# holds the connection settings of every shard and routes each
+# userid to a shard; all of a user's jobs and songs live on that
+# shard. The users table is a reference table present on every
+# shard.
+#
+# A job is identified to clients by a global jobid that encodes
+# its shard: shard * SHARD_ID_SPAN + the jobid within the shard,
+# so /result/{jobid} and /recommendations/{jobid} find the shard
+# without a global lookup. Shard 0's global jobids equal its
+# local ones, so an unsharded deployment (a single shard) keeps
+# its existing jobids. Likewise S3 bucket keys of jobs on shard
+# N > 0 have the form "musicapp/shard-N/<username>/<file>", one
+# level deeper than the "musicapp/<username>/<file>" of shard 0,
+# so the S3-triggered analysis handlers can find the job (even for
+# a shard 0 user named e.g. "shard-2").
+#
+SHARD_ID_SPAN = 1000000000
+
+_RE_BUCKETKEY_SHARD = re.compile(r"^musicapp/shard-(\d+)/[^/]+/[^/]+$")
+
+
+class ShardMap:
+
+  def __init__(self, shards):
+    #
+    # shards: list of dictionaries of get_routed_dbConn
+    # keyword arguments, one per shard:
+    #
+    if len(shards) == 0:
+      raise Exception("datatier: a ShardMap needs at least one shard")
+    self.shards = shards
+
+  @staticmethod
+  def from_config(configur):
+    """
+    Builds the shard map from a config file: sections rds-shard-0,
+    rds-shard-1, ... if present, otherwise the single rds section
+    """
+    sections = []
+    while configur.has_section("rds-shard-" + str(len(sections))):
+      sections.append("rds-shard-" + str(len(sections)))
+
+    if len(sections) == 0:
+      sections = ["rds"]
+
+    shards = []
+    for section in sections:
+      username = configur.get(section, 'user_name')
+      pwd = configur.get(section, 'user_pwd')
+      shards.append({
+        "endpoint": configur.get(section, 'endpoint'),
+        "portnum": int(configur.get(section, 'port_number')),
+        "username": username,
+        "pwd": pwd,
+        "dbname": configur.get(section, 'db_name'),
+        "read_endpoints": configur.get(section, 'read_endpoints', fallback=''),
+        "read_username": configur.get(section, 'read_user_name', fallback=username),
+        "read_pwd": configur.get(section, 'read_user_pwd', fallback=pwd)
+      })
+
+    return ShardMap(shards)
+
+  def __len__(self):
+    return len(self.shards)
+
+  def shard_for_user(self, userid):
+    return int(userid) % len(self.shards)
+
+  def shard_for_bucketkey(self, bucketkey):
+    m = _RE_BUCKETKEY_SHARD.search(bucketkey)
+    return 0 if m is None else int(m.group(1))
+
+  def bucketkey_tag(self, shard):
+    """
+    Returns the part of a bucket key that records the shard
+    """
+    return "" if shard == 0 else "shard-" + str(shard) + "/"
+
+  def get_dbConn(self, shard):
+    """
+    Returns a (routed) connection to the given shard
+    """
+    if shard < 0 or shard >= len(self.shards):
+      raise Exception("datatier: no such shard " + str(shard))
+    return get_routed_dbConn(**self.shards[shard])
+
+
+###################################################################
+#
+# encode_jobid / decode_jobid:
+#
+# Convert between a shard's jobid and the global jobid returned
+# to clients.
+#
+def encode_jobid(shard, local_jobid):
+  return shard * SHARD_ID_SPAN + int(local_jobid)
+
+
+def decode_jobid(jobid):
+  """
+  Splits a global jobid into (shard, jobid within the shard)
+  """
+  return divmod(int(jobid), SHARD_ID_SPAN)
+
+
+###################################################################
+#
+# query cache:
+#
+# A read-through cache for retrieve_one_row and retrieve_all_rows,
+# keyed by database, SQL and parameters. Caching is opt-in per
+# query by passing ttl=... to the retrieve function, so only
+# immutable or slow-changing lookups (e.g. "does this user
+# exist?") are cached. Entries expire after their TTL, the least
+# recently used entry is evicted once CACHE_MAX_ENTRIES is
+# reached, and invalidate_cache() drops entries explicitly.
+#
+CACHE_MAX_ENTRIES = 1024
+
+_MISSING = lrucache.MISSING
+
+
+class QueryCache(lrucache.LRUCache):
+
+  def __init__(self, max_entries=None):
+    super().__init__(CACHE_MAX_ENTRIES if max_entries is None else max_entries)
+
+  def invalidate(self, sql=None, parameters=None):
+    """
+    Drops cached entries: all of them if sql is None, else those
+    for sql (and parameters, if given); returns # dropped
+    """
+    if sql is None:
+      return super().invalidate()
+
+    params = None if parameters is None else tuple(parameters)
+    return super().invalidate(lambda key: key[1] == sql and (params is None or key[2] == params))
+
+
+query_cache = QueryCache()
+
+
+def _cache_key(dbConn, sql, parameters):
+  # same SQL against a different server or database is a
+  # different entry:
+  db = (getattr(dbConn, "host", None), getattr(dbConn, "port", None), getattr(dbConn, "db", None))
+  return (db, sql, tuple(parameters))
+
+
+def _cache_ttl(ttl, result):
+  # ttl is either # of seconds, or a function of the result
+  # returning # of seconds (0 => don't cache this result):
+  if callable(ttl):
+    return ttl(result)
+  return ttl
+
+
+###################################################################
+#
+# invalidate_cache:
+#
+# Explicit invalidation hook for the query cache; call after an
+# action query changes data that a cached query reads.
+#
+def invalidate_cache(sql=None, parameters=None):
+  """
+  Drops entries from the query cache
+
+  Parameters
+  __________
+  sql : optional SQL SELECT query whose entries to drop; if
+    omitted the entire cache is cleared,
+  parameters: optional list of values, to drop only the entry
+    for sql with these parameters
+
+  Returns
+  _______
+  number of entries dropped
+  """
+  return query_cache.invalidate(sql, parameters)
+
+
 ##################################################################
 #
 # retrieve_one_row:
@@ -61,7 +977,7 @@ def get_dbConn(endpoint, portnum, username, pwd, dbname):
 # can be parameterized using %s, in which case pass the
 # values as a list [value1, value2, ...]
 #
-def retrieve_one_row(dbConn, sql, parameters=[]):
+def retrieve_one_row(dbConn, sql, parameters=[], ttl=None):
   """
   Executes an sql SELECT query against the database connection
   and returns the first row as a tuple
@@ -70,22 +986,32 @@ def retrieve_one_row(dbConn, sql, parameters=[]):
   __________
   dbConn : the database connection, 
   sql : the SQL SELECT query (can be parameterized with %s),
-  parameters: optional list of values if parameterized
+  parameters: optional list of values if parameterized,
+  ttl: optional # of seconds to cache the result, or a function
+    taking the row and returning # of seconds (0 => don't cache)
 
   Returns
   _______
   First row as a tuple, or () if SELECT retrieves no data
   """
 
+  if ttl is not None:
+    key = _cache_key(dbConn, sql, parameters)
+    row = query_cache.get(key)
+    if row is not _MISSING:
+      return row
+
+  dbConn = _read_conn(dbConn)
   dbCursor = dbConn.cursor()
+  start = time.perf_counter()
+  ok = False
 
   try:
     dbCursor.execute(sql, parameters)
     row = dbCursor.fetchone()
     if row is None:  # executed successfully, but no data was retrieved
-      return ()
-    else:
-      return row
+      row = ()
+    ok = True
 
   except Exception as err:
     print("datatier.retrieve_one_row() failed:")
@@ -94,6 +1020,12 @@ def retrieve_one_row(dbConn, sql, parameters=[]):
 
   finally:
     dbCursor.close()
+    _record_query("retrieve_one_row", sql, start, 1 if ok and row != () else 0, ok)
+
+  if ttl is not None:
+    query_cache.put(key, row, _cache_ttl(ttl, row))
+
+  return row
 
 
 ##################################################################
@@ -107,7 +1039,7 @@ def retrieve_one_row(dbConn, sql, parameters=[]):
 # The query can be parameterized using %s, in which case
 # pass the values as a list [value1, value2, ...]
 #
-def retrieve_all_rows(dbConn, sql, parameters=[]):
+def retrieve_all_rows(dbConn, sql, parameters=[], ttl=None):
   """
   Executes an sql SELECT query against the database connection
   and returns all rows as a list of tuples
@@ -116,7 +1048,9 @@ def retrieve_all_rows(dbConn, sql, parameters=[]):
   __________
   dbConn : the database connection, 
   sql : the SQL SELECT query (can be parameterized with %s),
-  parameters: optional list of values if parameterized
+  parameters: optional list of values if parameterized,
+  ttl: optional # of seconds to cache the result, or a function
+    taking the rows and returning # of seconds (0 => don't cache)
 
   Returns
   _______
@@ -124,15 +1058,23 @@ def retrieve_all_rows(dbConn, sql, parameters=[]):
   data
   """
 
+  if ttl is not None:
+    key = _cache_key(dbConn, sql, parameters)
+    rows = query_cache.get(key)
+    if rows is not _MISSING:
+      return rows
+
+  dbConn = _read_conn(dbConn)
   dbCursor = dbConn.cursor()
+  start = time.perf_counter()
+  ok = False
 
   try:
     dbCursor.execute(sql, parameters)
     rows = dbCursor.fetchall()
     if rows is None:  # executed successfully, but no data was retrieved
-      return []
-    else:
-      return rows
+      rows = []
+    ok = True
 
   except Exception as err:
     print("datatier.retrieve_all_rows() failed:")
@@ -141,6 +1083,150 @@ def retrieve_all_rows(dbConn, sql, parameters=[]):
 
   finally:
     dbCursor.close()
+    _record_query("retrieve_all_rows", sql, start, len(rows) if ok else 0, ok)
+
+  if ttl is not None:
+    query_cache.put(key, rows, _cache_ttl(ttl, rows))
+
+  return rows
+
+
+##################################################################
+#
+# iter_rows:
+#
+# Given a database connection and an SQL Select query,
+# executes this query against the database and yields the
+# rows (tuples) one at a time. Unlike retrieve_all_rows, the
+# rows are streamed from the server with an unbuffered
+# (server-side) cursor, batch_size rows per fetch, so memory
+# use stays constant no matter how many rows the query
+# returns. The query can be parameterized using %s, in which
+# case pass the values as a list [value1, value2, ...]
+#
+# NOTE: the connection cannot be used for other queries until
+# the iteration finishes (or the generator is closed).
+#
+ITER_BATCH_SIZE = 500
+
+def iter_rows(dbConn, sql, parameters=[], batch_size=ITER_BATCH_SIZE):
+  """
+  Executes an sql SELECT query against the database connection
+  and yields the rows one at a time as tuples, streaming them
+  from the server in batches
+
+  Parameters
+  __________
+  dbConn : the database connection, 
+  sql : the SQL SELECT query (can be parameterized with %s),
+  parameters: optional list of values if parameterized,
+  batch_size: optional # of rows to fetch per round-trip
+
+  Returns
+  _______
+  A generator of rows as tuples; yields nothing if SELECT
+  retrieves no data
+  """
+
+  dbConn = _read_conn(dbConn)
+  dbCursor = dbConn.cursor(pymysql.cursors.SSCursor)
+  start = time.perf_counter()  # timed until the last row is consumed
+  nrows = 0
+  ok = False
+
+  try:
+    dbCursor.execute(sql, parameters)
+
+    while True:
+      rows = dbCursor.fetchmany(batch_size)
+      if not rows:  # result set exhausted
+        break
+      nrows += len(rows)
+      for row in rows:
+        yield row
+
+    ok = True
+
+  except Exception as err:
+    print("datatier.iter_rows() failed:")
+    print(str(err))
+    raise
+
+  finally:
+    dbCursor.close()
+    _record_query("iter_rows", sql, start, nrows, ok)
+
+
+###############################################################
+#
+# transaction:
+#
+# Context manager that groups several action queries into one
+# transaction:
+#
+#   with datatier.transaction(dbConn):
+#     datatier.perform_action(dbConn, sql1, [...])
+#     datatier.perform_action(dbConn, sql2, [...])
+#
+# Inside the with block perform_action and perform_action_many
+# do not commit; the changes are committed once when the block
+# exits, or rolled back once if it raises. Nested with blocks
+# join the outermost transaction.
+#
+@contextmanager
+def transaction(dbConn):
+  """
+  Runs the body of a with statement as one database transaction
+
+  Parameters
+  __________
+  dbConn : the database connection
+
+  Returns
+  _______
+  the database connection (as the with target)
+  """
+
+  conn = _write_conn(dbConn)
+  depth = _transaction_depth(conn)
+
+  if depth > 0:  # nested, the outer transaction commits
+    conn._datatier_tx = depth + 1
+    try:
+      yield dbConn
+    finally:
+      conn._datatier_tx = depth
+    return
+
+  conn.begin()
+  conn._datatier_tx = 1
+
+  try:
+    yield dbConn
+    conn.commit()
+
+  except Exception as err:
+    # failed, rollback all the changes and log error:
+    conn.rollback()
+    print("datatier.transaction() rolled back:")
+    print(str(err))
+    raise
+
+  finally:
+    conn._datatier_tx = 0
+
+
+def _transaction_depth(dbConn):
+  return getattr(dbConn, "_datatier_tx", 0)
+
+
+def _needs_commit(dbConn):
+  # outside a transaction on an autocommit connection (which
+  # pooled connections are) the statement is already committed,
+  # so an explicit COMMIT would be a wasted round-trip:
+  if _transaction_depth(dbConn) > 0:
+    return False
+  return not dbConn.get_autocommit()
 
 
 ###############################################################
@@ -153,9 +1239,10 @@ def retrieve_all_rows(dbConn, sql, parameters=[]):
 # modified. Action queries are typically "insert",
 # "update", "delete". The query can be parameterized
 # using %s, in which case pass the values as a list
-# [value1, value2, ...]
+# [value1, value2, ...]. Pass lastrowid=True to instead
+# get back the auto-generated id of an inserted row.
 #
-def perform_action(dbConn, sql, parameters=[]):
+def perform_action(dbConn, sql, parameters=[], lastrowid=False):
   """
   Executes an sql ACTION query against the database connection
   and returns number of rows modified
@@ -164,29 +1251,99 @@ def perform_action(dbConn, sql, parameters=[]):
   __________
   dbConn : the database connection, 
   sql : the SQL SELECT query (can be parameterized with %s),
-  parameters: optional list of values if parameterized
+  parameters: optional list of values if parameterized,
+  lastrowid: optional, if True return the AUTO_INCREMENT id of
+    the inserted row instead of the # of rows modified
 
   Returns
   _______
   number of rows modified (0 is not an error but implies
-  the query made no modifications)
+  the query made no modifications), or the id of the inserted
+  row if lastrowid is True
   """
 
+  dbConn = _write_conn(dbConn)
   dbCursor = dbConn.cursor()
+  start = time.perf_counter()
+  ok = False
 
   try:
     # try to execute, and if successful commit the changes
-    # and return the # of rows modified by the query:
+    # (unless we are inside a transaction) and return the
+    # # of rows modified by the query:
     dbCursor.execute(sql, parameters)
-    dbConn.commit()
+    if _needs_commit(dbConn):
+      dbConn.commit()
+    ok = True
+    if lastrowid:
+      return dbCursor.lastrowid
     return dbCursor.rowcount
 
   except Exception as err:
-    # failed, rollback any possible changes and log error:
-    dbConn.rollback()
+    # failed, rollback any possible changes and log error;
+    # inside a transaction, transaction() does the rollback:
+    if _transaction_depth(dbConn) == 0:
+      dbConn.rollback()
     print("datatier.perform_action() failed:")
     print(str(err))
     raise
 
   finally:
+    _record_query("perform_action", sql, start, dbCursor.rowcount if ok else 0, ok)
     dbCursor.close()
+
+
+###############################################################
+#
+# perform_action_many:
+#
+# Given a database connection, an SQL action query and a list
+# of parameter lists, executes the query once per parameter
+# list in a single transaction and returns the total number
+# of rows modified. For INSERT ... VALUES queries the rows are
+# sent to the server as one multi-row statement, so N rows cost
+# one round-trip and one commit instead of N. Inside a
+# transaction() block the rows become part of that transaction.
+#
+def perform_action_many(dbConn, sql, parameters_list):
+  """
+  Executes an sql ACTION query against the database connection
+  once for each list of parameters, and returns the total 
+  number of rows modified; all changes are committed together
+
+  Parameters
+  __________
+  dbConn : the database connection, 
+  sql : the SQL ACTION query (parameterized with %s),
+  parameters_list: list of parameter lists, one per execution
+
+  Returns
+  _______
+  total number of rows modified (0 is not an error but implies
+  the query made no modifications)
+  """
+
+  if len(parameters_list) == 0:  # nothing to do
+    return 0
+
+  dbConn = _write_conn(dbConn)
+
+  try:
+    with transaction(dbConn):
+      dbCursor = dbConn.cursor()
+      start = time.perf_counter()
+      ok = False
+
+      try:
+        dbCursor.executemany(sql, parameters_list)
+        ok = True
+        return dbCursor.rowcount
+
+      finally:
+        _record_query("perform_action_many", sql, start, dbCursor.rowcount if ok else 0, ok)
+        dbCursor.close()
+
+  except Exception as err:
+    print("datatier.perform_action_many() failed:")
+    print(str(err))
+    raise
@@ -0,0 +1,479 @@
+#
+# datatier_async.py
+#
+# Asyncio version of datatier.py: executes SQL queries against a
+# MySQL database using aiomysql, so independent queries can run
+# concurrently, e.g.
+#
+#   (user, job, songs) = await asyncio.gather(
+#     datatier_async.retrieve_one_row(conn1, sql1, [userid]),
+#     datatier_async.retrieve_one_row(conn2, sql2, [jobid]),
+#     datatier_async.retrieve_all_rows(conn3, sql3, [userid]))
+#
+# A connection runs one query at a time, so each concurrent query
+# needs its own connection from get_dbConn(). The functions mirror
+# datatier's, and share its query cache, timing statistics and
+# slow-query log.
+#
+
+import aiomysql
+import asyncio
+import datatier
+import time
+
+from contextlib import asynccontextmanager
+
+
+###################################################################
+#
+# connection pools:
+#
+# One aiomysql pool per database and event loop (an aiomysql pool
+# cannot be used from another loop). Pools of closed loops are
+# discarded the next time a pool is requested. Pool size and idle
+# limits follow datatier's settings.
+#
+_pools = {}
+
+
+async def _get_pool(endpoint, portnum, username, pwd, dbname):
+  loop = asyncio.get_running_loop()
+
+  for (key, (pool_loop, pool)) in list(_pools.items()):
+    if pool_loop.is_closed():
+      del _pools[key]
+
+  key = (id(loop), endpoint, portnum, username, pwd, dbname)
+  entry = _pools.get(key)
+  if entry is not None:
+    return entry[1]
+
+  pool = await aiomysql.create_pool(host=endpoint,
+                                    port=portnum,
+                                    user=username,
+                                    password=pwd,
+                                    db=dbname,
+                                    autocommit=True,
+                                    minsize=0,
+                                    maxsize=datatier.POOL_MAX_SIZE,
+                                    pool_recycle=datatier.POOL_MAX_IDLE)
+
+  #
+  # another task may have created the pool while we awaited:
+  #
+  entry = _pools.get(key)
+  if entry is not None:
+    pool.close()
+    return entry[1]
+
+  _pools[key] = (loop, pool)
+  return pool
+
+
+###################################################################
+#
+# AsyncPooledConnection:
+#
+# Wrapper around a connection acquired from a pool; "await
+# dbConn.close()" (or leaving "async with") returns it to the
+# pool.
+#
+class AsyncPooledConnection:
+
+  def __init__(self, pool, conn):
+    self._pool = pool
+    self._conn = conn
+
+  def __getattr__(self, name):
+    conn = self.__dict__.get("_conn")
+    if conn is None:
+      raise Exception("datatier_async: connection has already been returned to the pool")
+    return getattr(conn, name)
+
+  async def close(self):
+    conn = self._conn
+    if conn is not None:
+      self._conn = None
+      await self._pool.release(conn)
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, traceback):
+    await self.close()
+    return False
+
+
+###################################################################
+#
+# get_dbConn:
+#
+# Returns a connection object for interacting with a MySQL
+# database, taken from a pool for the running event loop.
+#
+async def get_dbConn(endpoint, portnum, username, pwd, dbname):
+  """
+  Returns a pooled connection object for interacting
+  with a MySQL database
+
+  Parameters
+  ----------
+  endpoint : machine name or IP address of server (string),
+  portnum : server port # (integer),
+  username : user name for login (string),
+  pwd : user password for login (string),
+  dbname : database name (string)
+
+  Returns
+  -------
+  a connection object; "await close()" returns it to the pool
+  """
+  try:
+    pool = await _get_pool(endpoint, portnum, username, pwd, dbname)
+    conn = await pool.acquire()
+
+    return AsyncPooledConnection(pool, conn)
+
+  except Exception as err:
+    print("datatier_async.get_dbConn() failed:")
+    print(str(err))
+    raise
+
+
+###################################################################
+#
+# close_pools:
+#
+# Closes the pools of the running event loop, e.g. before the
+# loop ends.
+#
+async def close_pools():
+  loop = asyncio.get_running_loop()
+
+  for (key, (pool_loop, pool)) in list(_pools.items()):
+    if pool_loop is loop:
+      del _pools[key]
+      pool.close()
+      await pool.wait_closed()
+
+
+##################################################################
+#
+# retrieve_one_row:
+#
+# Async version of datatier.retrieve_one_row.
+#
+async def retrieve_one_row(dbConn, sql, parameters=[], ttl=None):
+  """
+  Executes an sql SELECT query against the database connection
+  and returns the first row as a tuple
+
+  Parameters
+  __________
+  dbConn : the database connection,
+  sql : the SQL SELECT query (can be parameterized with %s),
+  parameters: optional list of values if parameterized,
+  ttl: optional # of seconds to cache the result, or a function
+    taking the row and returning # of seconds (0 => don't cache)
+
+  Returns
+  _______
+  First row as a tuple, or () if SELECT retrieves no data
+  """
+
+  if ttl is not None:
+    key = datatier._cache_key(dbConn, sql, parameters)
+    row = datatier.query_cache.get(key)
+    if row is not datatier._MISSING:
+      return row
+
+  dbCursor = await dbConn.cursor()
+  start = time.perf_counter()
+  ok = False
+
+  try:
+    await dbCursor.execute(sql, parameters)
+    row = await dbCursor.fetchone()
+    if row is None:  # executed successfully, but no data was retrieved
+      row = ()
+    ok = True
+
+  except Exception as err:
+    print("datatier_async.retrieve_one_row() failed:")
+    print(str(err))
+    raise
+
+  finally:
+    await dbCursor.close()
+    datatier._record_query("retrieve_one_row", sql, start, 1 if ok and row != () else 0, ok)
+
+  if ttl is not None:
+    datatier.query_cache.put(key, row, datatier._cache_ttl(ttl, row))
+
+  return row
+
+
+##################################################################
+#
+# retrieve_all_rows:
+#
+# Async version of datatier.retrieve_all_rows.
+#
+async def retrieve_all_rows(dbConn, sql, parameters=[], ttl=None):
+  """
+  Executes an sql SELECT query against the database connection
+  and returns all rows as a list of tuples
+
+  Parameters
+  __________
+  dbConn : the database connection,
+  sql : the SQL SELECT query (can be parameterized with %s),
+  parameters: optional list of values if parameterized,
+  ttl: optional # of seconds to cache the result, or a function
+    taking the rows and returning # of seconds (0 => don't cache)
+
+  Returns
+  _______
+  All rows as a list of tuples, or [] if SELECT retrieves no
+  data
+  """
+
+  if ttl is not None:
+    key = datatier._cache_key(dbConn, sql, parameters)
+    rows = datatier.query_cache.get(key)
+    if rows is not datatier._MISSING:
+      return rows
+
+  dbCursor = await dbConn.cursor()
+  start = time.perf_counter()
+  ok = False
+
+  try:
+    await dbCursor.execute(sql, parameters)
+    rows = await dbCursor.fetchall()
+    if rows is None:  # executed successfully, but no data was retrieved
+      rows = []
+    ok = True
+
+  except Exception as err:
+    print("datatier_async.retrieve_all_rows() failed:")
+    print(str(err))
+    raise
+
+  finally:
+    await dbCursor.close()
+    datatier._record_query("retrieve_all_rows", sql, start, len(rows) if ok else 0, ok)
+
+  if ttl is not None:
+    datatier.query_cache.put(key, rows, datatier._cache_ttl(ttl, rows))
+
+  return rows
+
+
+##################################################################
+#
+# iter_rows:
+#
+# Async version of datatier.iter_rows, an async generator:
+#
+#   async for row in datatier_async.iter_rows(dbConn, sql):
+#     ...
+#
+async def iter_rows(dbConn, sql, parameters=[], batch_size=datatier.ITER_BATCH_SIZE):
+  """
+  Executes an sql SELECT query against the database connection
+  and yields the rows one at a time as tuples, streaming them
+  from the server in batches
+
+  Parameters
+  __________
+  dbConn : the database connection,
+  sql : the SQL SELECT query (can be parameterized with %s),
+  parameters: optional list of values if parameterized,
+  batch_size: optional # of rows to fetch per round-trip
+
+  Returns
+  _______
+  An async generator of rows as tuples
+  """
+
+  dbCursor = await dbConn.cursor(aiomysql.SSCursor)
+  start = time.perf_counter()
+  nrows = 0
+  ok = False
+
+  try:
+    await dbCursor.execute(sql, parameters)
+
+    while True:
+      rows = await dbCursor.fetchmany(batch_size)
+      if not rows:  # result set exhausted
+        break
+      nrows += len(rows)
+      for row in rows:
+        yield row
+
+    ok = True
+
+  except Exception as err:
+    print("datatier_async.iter_rows() failed:")
+    print(str(err))
+    raise
+
+  finally:
+    await dbCursor.close()
+    datatier._record_query("iter_rows", sql, start, nrows, ok)
+
+
+###############################################################
+#
+# transaction:
+#
+# Async version of datatier.transaction:
+#
+#   async with datatier_async.transaction(dbConn):
+#     await datatier_async.perform_action(dbConn, sql1, [...])
+#     await datatier_async.perform_action(dbConn, sql2, [...])
+#
+@asynccontextmanager
+async def transaction(dbConn):
+  """
+  Runs the body of an async with statement as one database
+  transaction
+
+  Parameters
+  __________
+  dbConn : the database connection
+
+  Returns
+  _______
+  the database connection (as the with target)
+  """
+
+  depth = datatier._transaction_depth(dbConn)
+
+  if depth > 0:  # nested, the outer transaction commits
+    dbConn._datatier_tx = depth + 1
+    try:
+      yield dbConn
+    finally:
+      dbConn._datatier_tx = depth
+    return
+
+  await dbConn.begin()
+  dbConn._datatier_tx = 1
+
+  try:
+    yield dbConn
+    await dbConn.commit()
+
+  except Exception as err:
+    # failed, rollback all the changes and log error:
+    await dbConn.rollback()
+    print("datatier_async.transaction() rolled back:")
+    print(str(err))
+    raise
+
+  finally:
+    dbConn._datatier_tx = 0
+
+
+###############################################################
+#
+# perform_action:
+#
+# Async version of datatier.perform_action.
+#
+async def perform_action(dbConn, sql, parameters=[], lastrowid=False):
+  """
+  Executes an sql ACTION query against the database connection
+  and returns number of rows modified
+
+  Parameters
+  __________
+  dbConn : the database connection,
+  sql : the SQL ACTION query (can be parameterized with %s),
+  parameters: optional list of values if parameterized,
+  lastrowid: optional, if True return the AUTO_INCREMENT id of
+    the inserted row instead of the # of rows modified
+
+  Returns
+  _______
+  number of rows modified (0 is not an error but implies
+  the query made no modifications), or the id of the inserted
+  row if lastrowid is True
+  """
+
+  dbCursor = await dbConn.cursor()
+  start = time.perf_counter()
+  ok = False
+
+  try:
+    await dbCursor.execute(sql, parameters)
+    if datatier._needs_commit(dbConn):
+      await dbConn.commit()
+    ok = True
+    if lastrowid:
+      return dbCursor.lastrowid
+    return dbCursor.rowcount
+
+  except Exception as err:
+    # failed, rollback any possible changes and log error;
+    # inside a transaction, transaction() does the rollback:
+    if datatier._transaction_depth(dbConn) == 0:
+      await dbConn.rollback()
+    print("datatier_async.perform_action() failed:")
+    print(str(err))
+    raise
+
+  finally:
+    datatier._record_query("perform_action", sql, start, dbCursor.rowcount if ok else 0, ok)
+    await dbCursor.close()
+
+
+###############################################################
+#
+# perform_action_many:
+#
+# Async version of datatier.perform_action_many.
+#
+async def perform_action_many(dbConn, sql, parameters_list):
+  """
+  Executes an sql ACTION query against the database connection
+  once for each list of parameters, and returns the total
+  number of rows modified; all changes are committed together
+
+  Parameters
+  __________
+  dbConn : the database connection,
+  sql : the SQL ACTION query (parameterized with %s),
+  parameters_list: list of parameter lists, one per execution
+
+  Returns
+  _______
+  total number of rows modified (0 is not an error but implies
+  the query made no modifications)
+  """
+
+  if len(parameters_list) == 0:  # nothing to do
+    return 0
+
+  try:
+    async with transaction(dbConn):
+      dbCursor = await dbConn.cursor()
+      start = time.perf_counter()
+      ok = False
+
+      try:
+        await dbCursor.executemany(sql, parameters_list)
+        ok = True
+        return dbCursor.rowcount
+
+      finally:
+        datatier._record_query("perform_action_many", sql, start, dbCursor.rowcount if ok else 0, ok)
+        await dbCursor.close()
+
+  except Exception as err:
+    print("datatier_async.perform_action_many() failed:")
+    print(str(err))
+    raise
@@ -1,12 +1,132 @@
-import requests
+import codecs
+import datetime
+import hashlib
+import itertools
+import json
+import lrucache
+import threading
+import unicodedata
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+CHUNK_CHARS = 1500       # ~400 tokens, inside the model's 512-token window
+READ_WINDOW = 64 * 1024  # bytes read from a stream at a time
+EMOTION_CONCURRENCY = 4  # chunks classified at once
+ENGINE_BATCH_SIZE = 16   # chunks per in-process engine call
+
+EMOTION_MODEL = "j-hartmann/emotion-english-distilroberta-base"
+
+# emotion score cache, see get_emotion_scores:
+CACHE_MAX_ENTRIES = 8192          # in-process tier; entries are ~0.5 KB, so ~4 MB
+CACHE_TTL = 30 * 24 * 3600        # seconds an entry is used; shared tier: [emotion] cache_ttl in config
+CACHE_PREFIX = "emotion-cache/"   # S3 prefix of the shared tier, outside the uploads' musicapp/
+
+_cache = lrucache.LRUCache(CACHE_MAX_ENTRIES)
+_shared_stats = {"hits": 0, "misses": 0}  # shared tier lookups, after an in-process miss
+_shared_lock = threading.Lock()
+
+def get_cache_stats():
+  """Size and hit/miss counters of the emotion score cache."""
+  with _shared_lock:
+    return {
+      "entries": len(_cache),
+      "max_entries": _cache.max_entries,
+      "hits": _cache.hits,
+      "misses": _cache.misses,
+      "shared_hits": _shared_stats["hits"],
+      "shared_misses": _shared_stats["misses"]
+    }
+
+def normalize_text(text):
+  """Text as the cache sees it."""
+  # Unicode NFKC, case-folded, whitespace collapsed, so near-identical texts share an entry
+  return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+def cache_key(text, model=EMOTION_MODEL):
+  """Cache key of a text's scores."""
+  # SHA-256 of the model id and the normalized text
+  return hashlib.sha256((model + "\n" + normalize_text(text)).encode("utf-8")).hexdigest()
+
+def _shared_ttl():
+  """Seconds a shared tier entry is used, 0 if the shared tier is off."""
+  import bootstrap  # here, so emotion alone needs no database drivers
+  return bootstrap.get_config().getint('emotion', 'cache_ttl', fallback=CACHE_TTL)
+
+def _shared_bucket():
+  """Bucket of the shared tier: [emotion] cache_bucket, else the app's bucket."""
+  import bootstrap
+  configur = bootstrap.get_config()
+  return configur.get('emotion', 'cache_bucket', fallback=configur.get('s3', 'bucket_name'))
+
+def _shared_get(key, ttl):
+  """Scores from the shared tier, or None."""
+  import bootstrap
+
+  # an S3 object per key; a missing, expired or unreadable one is a miss
+  try:
+    s3 = bootstrap.get_s3_client()
+    bucketname = _shared_bucket()
+    try:
+      obj = s3.get_object(Bucket=bucketname, Key=CACHE_PREFIX + key)
+    except s3.exceptions.NoSuchKey:
+      return None
+
+    age = datetime.datetime.now(datetime.timezone.utc) - obj['LastModified']
+    if age.total_seconds() > ttl:
+      return None
+    return json.loads(obj['Body'].read())
+  except Exception as err:
+    print("**WARNING: emotion cache read failed:", str(err))
+    return None
+
+def _shared_put(key, scores):
+  """Store scores in the shared tier."""
+  import bootstrap
+
+  # a failure only costs a future miss
+  try:
+    s3 = bootstrap.get_s3_client()
+    bucketname = _shared_bucket()
+    s3.put_object(Bucket=bucketname, Key=CACHE_PREFIX + key, Body=json.dumps(scores).encode("utf-8"), ContentType="application/json")
+  except Exception as err:
+    print("**WARNING: emotion cache write failed:", str(err))
 
 def get_emotion_scores(text, api_key):
+  """Get emotion scores, cached, using Hugging Face Inference API."""
+  # A text classified before (after normalize_text) is served from the
+  # in-process LRU tier, else from the shared tier in S3; a text
+  # found in neither is classified and cached in both.
+  key = cache_key(text)
+
+  scores = _cache.get(key)
+  if scores is not lrucache.MISSING:
+    return scores
+
+  ttl = _shared_ttl()
+  if ttl > 0:
+    scores = _shared_get(key, ttl)
+    with _shared_lock:
+      _shared_stats["hits" if scores is not None else "misses"] += 1
+    if scores is not None:
+      _cache.put(key, scores, CACHE_TTL)
+      return scores
+
+  scores = _classify(text, api_key)
+  if scores is not None:
+    _cache.put(key, scores, CACHE_TTL)
+    if ttl > 0:
+      _shared_put(key, scores)
+  return scores
+
+def _classify(text, api_key):
   """Get emotion scores using Hugging Face Inference API."""
+  import bootstrap  # here, so emotion alone needs no database drivers
+
   print("Getting emotion scores...")
-  url = "https://api-inference.huggingface.co/models/j-hartmann/emotion-english-distilroberta-base"
+  url = "https://api-inference.huggingface.co/models/" + EMOTION_MODEL
   # Call inference API to classify text in Ekman's 6 basic emotions + neutral class
   headers = {"Authorization": f"Bearer {api_key}"}
-  response = requests.post(url, headers=headers, json={"inputs": text})
+  response = bootstrap.get_http_session().post(url, headers=headers, json={"inputs": text})  # pooled, keep-alive
 
   print("Received response from inference API")
   if response.status_code == 200:
@@ -17,42 +137,132 @@ def get_emotion_scores(text, api_key):
     print("Error:", response.json())
     return None
 
+def iter_text_chunks(stream, chunk_chars=CHUNK_CHARS):
+  """Yield the UTF-8 text of a binary stream in chunks."""
+  # at most chunk_chars each, cut at whitespace where possible
+  decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+  buffer = ""
+
+  while True:
+    window = stream.read(READ_WINDOW)
+    buffer += decoder.decode(window, final=not window)
+
+    while len(buffer) >= chunk_chars or (not window and buffer != ""):
+      cut = len(buffer)
+      if cut > chunk_chars:
+        # cut after the last whitespace in the chunk, unless that leaves less than half a chunk:
+        cut = max(buffer.rfind(" ", 0, chunk_chars), buffer.rfind("\n", 0, chunk_chars)) + 1
+        if cut < chunk_chars // 2:
+          cut = chunk_chars
+      chunk = buffer[:cut].strip()
+      buffer = buffer[cut:]
+      if chunk != "":
+        yield chunk
+
+    if not window:
+      return
+
+def get_emotion_scores_chunked(stream, api_key, concurrency=EMOTION_CONCURRENCY, engine=None):
+  """Get emotion scores of a text stream of any length."""
+  # The text is classified in chunks, several at a time, and the chunks'
+  # scores are averaged, weighted by chunk length. With an in-process
+  # engine (see emotion_engine.py), the engine classifies the chunks in
+  # batches instead of the Inference API.
+  totals = {}
+  weight = 0
+  pending = set()
+
+  def add(chunk, scores):
+    nonlocal weight
+    for emotion in scores:
+      totals[emotion['label']] = totals.get(emotion['label'], 0) + emotion['score'] * len(chunk)
+    weight += len(chunk)
+
+  if engine is not None:
+    chunks = iter_text_chunks(stream)
+    while True:
+      batch = list(itertools.islice(chunks, ENGINE_BATCH_SIZE))
+      if batch == []:
+        break
+      for (chunk, scores) in zip(batch, engine.classify(batch)):
+        add(chunk, scores)
+    return _weighted_scores(totals, weight)
+
+  def classify(chunk):
+    return (chunk, get_emotion_scores(chunk, api_key))
+
+  def collect(done):
+    for future in done:
+      (chunk, scores) = future.result()
+      if scores is None:
+        raise Exception("emotion analysis of a chunk failed")
+      add(chunk, scores)
+
+  executor = ThreadPoolExecutor(max_workers=concurrency)
+  try:
+    for chunk in iter_text_chunks(stream):
+      # at most 2 batches in flight, so memory stays bounded:
+      if len(pending) >= 2 * concurrency:
+        (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+        collect(done)
+      pending.add(executor.submit(classify, chunk))
+
+    collect(wait(pending)[0])
+  finally:
+    executor.shutdown(wait=True, cancel_futures=True)
+
+  return _weighted_scores(totals, weight)
+
+def _weighted_scores(totals, weight):
+  """Label/score list from the weighted score totals."""
+  # None if there was no text
+  if weight == 0:
+    return None
+
+  print("Classified", weight, "chars")
+  scores = [{'label': label, 'score': total / weight} for (label, total) in totals.items()]
+  scores.sort(key=lambda s: s['score'], reverse=True)  # like the Inference API
+  return scores
+
+# Arbitrary mappings on a scale of 0 to 1 (unlisted emotions count as 0.5)
+VALENCE_MAPPING = {
+  "sadness": 0.1, "anger": 0.3, "disgust": 0.3,
+  "fear": 0.2, "surprise": 0.7, "joy": 0.9, "neutral": 0.5
+}
+ENERGY_MAPPING = {
+  "sadness": 0.2, "anger": 0.8, "disgust": 0.4,
+  "fear": 0.7, "surprise": 0.9, "joy": 0.8, "neutral": 0.5
+}
+
+COLOR_MAPPING = {
+  "green": {"valence": 0.8, "energy": 0.5},
+  "pink": {"valence": 0.9, "energy": 0.6},
+  "black": {"valence": 0.2, "energy": 0.3},
+  "red": {"valence": 0.7, "energy": 0.9},
+  "yellow": {"valence": 1.0, "energy": 0.8},
+  "cyan": {"valence": 0.8, "energy": 0.7},
+  "brown": {"valence": 0.4, "energy": 0.3},
+  "orange": {"valence": 0.9, "energy": 0.8},
+  "white": {"valence": 0.9, "energy": 0.4},
+  "purple": {"valence": 0.6, "energy": 0.5},
+  "blue": {"valence": 0.7, "energy": 0.4},
+  "grey": {"valence": 0.5, "energy": 0.5}, # treat as neutral color since it's common
+}
+
+EMOTION_LABELS = list(VALENCE_MAPPING)  # column order of emotion score matrices
+COLOR_LABELS = list(COLOR_MAPPING)      # column order of color count matrices
+
 def map_emotions_to_valence_energy(emotions):
   """Map emotion scores to valence (happiness) and energy (activity)."""
-  # Arbitrary mappings on a scale of 0 to 1
-  valence_mapping = {
-    "sadness": 0.1, "anger": 0.3, "disgust": 0.3,
-    "fear": 0.2, "surprise": 0.7, "joy": 0.9, "neutral": 0.5
-  }
-  energy_mapping = {
-    "sadness": 0.2, "anger": 0.8, "disgust": 0.4,
-    "fear": 0.7, "surprise": 0.9, "joy": 0.8, "neutral": 0.5
-  }
-
   # Translate all scores to valence & energy and get the sum
-  valence = sum(emotion['score'] * valence_mapping.get(emotion['label'], 0.5) for emotion in emotions)
-  energy = sum(emotion['score'] * energy_mapping.get(emotion['label'], 0.5) for emotion in emotions)
+  valence = sum(emotion['score'] * VALENCE_MAPPING.get(emotion['label'], 0.5) for emotion in emotions)
+  energy = sum(emotion['score'] * ENERGY_MAPPING.get(emotion['label'], 0.5) for emotion in emotions)
   print("Valence: ", valence)
   print("Energy: ", energy)
     
   return round(valence, 2), round(energy, 2)
 
 def map_colors_to_valence_energy(colors):
-  color_mapping = {
-    "green": {"valence": 0.8, "energy": 0.5},
-    "pink": {"valence": 0.9, "energy": 0.6},
-    "black": {"valence": 0.2, "energy": 0.3},
-    "red": {"valence": 0.7, "energy": 0.9},
-    "yellow": {"valence": 1.0, "energy": 0.8},
-    "cyan": {"valence": 0.8, "energy": 0.7},
-    "brown": {"valence": 0.4, "energy": 0.3},
-    "orange": {"valence": 0.9, "energy": 0.8},
-    "white": {"valence": 0.9, "energy": 0.4},
-    "purple": {"valence": 0.6, "energy": 0.5},
-    "blue": {"valence": 0.7, "energy": 0.4},
-    "grey": {"valence": 0.5, "energy": 0.5}, # treat as neutral color since it's common
-  }
-
   print("Calculating valence and energy...")
 
   valence_sum = 0
@@ -61,7 +271,7 @@ def map_colors_to_valence_energy(colors):
 
   for color in colors:
     tag = color["SimplifiedColor"]
-    scores = color_mapping.get(tag)
+    scores = COLOR_MAPPING.get(tag)
     valence_sum += scores["valence"]
     energy_sum += scores["energy"]
     cnt += 1
@@ -71,4 +281,81 @@ def map_colors_to_valence_energy(colors):
 
   print("Valence: ", valence)
   print("Energy: ", energy)
-  return (valence, energy)
\ No newline at end of file
+  return (valence, energy)
+
+_weights = {}
+
+def _weight_matrices():
+  """The mapping tables as (labels, 2) valence/energy weight matrices."""
+  import numpy as np  # here, so the handlers never load it
+
+  # compiled once; rows in EMOTION_LABELS / COLOR_LABELS order, and the
+  # emotion matrix has an extra last row of 0.5s for unlisted emotions
+  if not _weights:
+    emotions = np.array([[VALENCE_MAPPING[label], ENERGY_MAPPING[label]] for label in EMOTION_LABELS] + [[0.5, 0.5]])
+    colors = np.array([[COLOR_MAPPING[tag]["valence"], COLOR_MAPPING[tag]["energy"]] for tag in COLOR_LABELS])
+    _weights.update(emotions=emotions, colors=colors)
+
+  return (_weights["emotions"], _weights["colors"])
+
+def emotion_score_matrix(score_sets):
+  """Matrix of emotion score lists, one row each."""
+  import numpy as np
+
+  # columns in EMOTION_LABELS order, and a last column for unlisted emotions
+  column = {label: i for (i, label) in enumerate(EMOTION_LABELS)}
+  other = len(EMOTION_LABELS)
+
+  matrix = np.zeros((len(score_sets), len(EMOTION_LABELS) + 1))
+  for (row, emotions) in enumerate(score_sets):
+    for emotion in emotions:
+      matrix[row, column.get(emotion['label'], other)] += emotion['score']
+  return matrix
+
+def color_count_matrix(color_sets):
+  """Matrix of the dominant color counts of images, one row each."""
+  import numpy as np
+
+  # columns in COLOR_LABELS order
+  column = {tag: i for (i, tag) in enumerate(COLOR_LABELS)}
+
+  matrix = np.zeros((len(color_sets), len(COLOR_LABELS)))
+  for (row, colors) in enumerate(color_sets):
+    for color in colors:
+      tag = color["SimplifiedColor"]
+      if tag not in column:
+        raise Exception("unknown color '" + str(tag) + "'")
+      matrix[row, column[tag]] += 1
+  return matrix
+
+def map_emotions_to_valence_energy_batch(score_sets):
+  """Map many emotion score sets to valence and energy at once."""
+  import numpy as np
+
+  # score_sets is a list of emotion score lists, or an emotion_score_matrix;
+  # returns an (n, 2) array of (valence, energy) rows, computed with one
+  # matrix multiply and without printing. Like the scalar path, values are
+  # rounded to 2 places, but with np.round and after summing in a different
+  # order, so a value that lies (within float error) on a rounding boundary,
+  # e.g. x.xx5, may come out 0.01 off the scalar path's.
+  (weights, _) = _weight_matrices()
+  if not isinstance(score_sets, np.ndarray):
+    score_sets = emotion_score_matrix(score_sets)
+  return np.round(score_sets @ weights, 2)
+
+def map_colors_to_valence_energy_batch(color_sets):
+  """Map many images' dominant colors to valence and energy at once."""
+  import numpy as np
+
+  # color_sets is a list of Rekognition DominantColors lists, or a
+  # color_count_matrix; returns an (n, 2) array of (valence, energy) rows,
+  # the mean over each image's colors, computed with one matrix multiply
+  # and without printing
+  (_, weights) = _weight_matrices()
+  if not isinstance(color_sets, np.ndarray):
+    color_sets = color_count_matrix(color_sets)
+
+  counts = color_sets.sum(axis=1, keepdims=True)
+  if (counts == 0).any():
+    raise Exception("an image has no dominant colors")
+  return (color_sets / counts) @ weights
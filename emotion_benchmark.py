@@ -0,0 +1,175 @@
+#
+# emotion_benchmark.py
+#
+# Micro-benchmark of emotion.py's valence/energy mapping: the
+# scalar functions the handlers call once per analysis, against
+# the batch functions (NumPy, one matrix multiply per batch) meant
+# for batch reprocessing. Checks that both give the same results.
+#
+# Usage:
+#   python emotion_benchmark.py [--runs N] [size ...]
+#
+# Each batch size (default 1 10 100 1000 10000) is timed N times
+# (default 5) with random score sets and random dominant colors,
+# and the best time of each path is reported, with the # of
+# values the batch path rounds differently (see
+# map_emotions_to_valence_energy_batch):
+#
+#   scalar : map_*_to_valence_energy per score set (its output
+#            discarded)
+#   batch  : map_*_to_valence_energy_batch on the list of score sets
+#   matrix : map_*_to_valence_energy_batch on a prebuilt score or
+#            color count matrix (the matrix multiply alone)
+#
+# Requires numpy.
+#
+
+import contextlib
+import io
+import random
+import sys
+import time
+
+import emotion
+
+
+DEFAULT_SIZES = [1, 10, 100, 1000, 10000]
+DEFAULT_RUNS = 5
+
+
+###################################################################
+#
+# random_score_sets / random_color_sets:
+#
+# n random inputs shaped like the Inference API's emotion scores
+# (every label, scores summing to 1) and Rekognition's dominant
+# colors (1 to 5 per image).
+#
+def random_score_sets(n, rng):
+  score_sets = []
+  for _ in range(n):
+    weights = [rng.random() for _ in emotion.EMOTION_LABELS]
+    total = sum(weights)
+    scores = [{'label': label, 'score': w / total} for (label, w) in zip(emotion.EMOTION_LABELS, weights)]
+    scores.sort(key=lambda s: s['score'], reverse=True)
+    score_sets.append(scores)
+  return score_sets
+
+
+def random_color_sets(n, rng):
+  return [[{'SimplifiedColor': rng.choice(emotion.COLOR_LABELS)} for _ in range(rng.randint(1, 5))]
+          for _ in range(n)]
+
+
+###################################################################
+#
+# best_time:
+#
+# Runs fn() runs times and returns the fastest, in ms, and fn's
+# result.
+#
+def best_time(fn, runs):
+  best = None
+  for _ in range(runs):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return (1000.0 * best, result)
+
+
+def scalar(mapping, inputs):
+  # the scalar functions print their results; discard that output
+  with contextlib.redirect_stdout(io.StringIO()):
+    return [mapping(x) for x in inputs]
+
+
+###################################################################
+#
+# compare:
+#
+# Checks the batch results against the scalar ones, and returns
+# the # of values that differ only by rounding a value on a
+# rounding boundary the other way. unrounded is the scalar path's
+# values before rounding, or None if the mapping does not round.
+#
+def compare(name, expected, result, unrounded):
+  ties = 0
+
+  for (i, row) in enumerate(result.tolist()):
+    for j in range(2):
+      (want, got) = (expected[i][j], row[j])
+      if abs(want - got) <= 1e-9:
+        continue
+
+      on_boundary = unrounded is not None and abs((unrounded[i][j] * 100) % 1 - 0.5) < 1e-6
+      if on_boundary and abs(want - got) <= 0.01 + 1e-9:
+        ties += 1
+        continue
+
+      raise Exception(name + ": batch result " + str(row) + " differs from scalar " + str(expected[i]))
+
+  return ties
+
+
+def unrounded_emotions(score_sets):
+  # map_emotions_to_valence_energy before rounding
+  return [(sum(s['score'] * emotion.VALENCE_MAPPING.get(s['label'], 0.5) for s in scores),
+           sum(s['score'] * emotion.ENERGY_MAPPING.get(s['label'], 0.5) for s in scores))
+          for scores in score_sets]
+
+
+###################################################################
+#
+# benchmark:
+#
+# Times the scalar, batch and matrix paths of one mapping for one
+# batch size, checks the results agree, and prints a line.
+#
+def benchmark(name, mapping, batch, to_matrix, unrounded, inputs, runs):
+  (scalar_ms, expected) = best_time(lambda: scalar(mapping, inputs), runs)
+  (batch_ms, result) = best_time(lambda: batch(inputs), runs)
+
+  matrix = to_matrix(inputs)
+  (matrix_ms, _) = best_time(lambda: batch(matrix), runs)
+
+  ties = compare(name, expected, result, None if unrounded is None else unrounded(inputs))
+
+  print("%-8s %7d %10.3f %10.3f %10.3f %9.1fx %9.1fx %6d" %
+        (name, len(inputs), scalar_ms, batch_ms, matrix_ms, scalar_ms / batch_ms, scalar_ms / matrix_ms, ties))
+
+
+###################################################################
+#
+# main
+#
+if __name__ == "__main__":
+  args = sys.argv[1:]
+
+  runs = DEFAULT_RUNS
+  if len(args) > 1 and args[0] == "--runs":
+    runs = int(args[1])
+    args = args[2:]
+
+  sizes = [int(arg) for arg in args] if len(args) > 0 else DEFAULT_SIZES
+
+  rng = random.Random(310)
+
+  print("%-8s %7s %10s %10s %10s %10s %10s %6s" %
+        ("mapping", "n", "scalar ms", "batch ms", "matrix ms", "batch", "matrix", "ties"))
+
+  for n in sizes:
+    benchmark("emotions",
+              emotion.map_emotions_to_valence_energy,
+              emotion.map_emotions_to_valence_energy_batch,
+              emotion.emotion_score_matrix,
+              unrounded_emotions,
+              random_score_sets(n, rng), runs)
+
+  for n in sizes:
+    benchmark("colors",
+              emotion.map_colors_to_valence_energy,
+              emotion.map_colors_to_valence_energy_batch,
+              emotion.color_count_matrix,
+              None,
+              random_color_sets(n, rng), runs)
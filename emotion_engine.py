@@ -0,0 +1,209 @@
+#
+# emotion_engine.py
+#
+# In-process emotion classifiers, alternatives to the HuggingFace
+# Inference API call in emotion.get_emotion_scores: no network,
+# no shared rate limit. Each engine classifies a batch of texts
+# and returns, per text, the same list the API does, e.g.
+#
+#   [{'label': 'joy', 'score': 0.91}, {'label': 'neutral', ...}, ...]
+#
+# (Ekman's 6 basic emotions + neutral, highest score first), so
+# emotion.map_emotions_to_valence_energy consumes it unchanged.
+#
+#   onnx    : an ONNX export of j-hartmann/emotion-english-
+#             distilroberta-base (the API's model), e.g. quantized
+#             to int8, run with onnxruntime on the CPU; needs
+#             onnxruntime, tokenizers and numpy
+#   lexicon : a small built-in word list, no dependencies; a rough
+#             fallback when the model is not available
+#
+# get_engine() loads an engine once per process and reuses it.
+#
+
+import json
+import pathlib
+import re
+import threading
+
+
+#
+# the model's labels, in the order of its outputs (config.json
+# id2label, used if the model directory has one):
+#
+LABELS = ["anger", "disgust", "fear", "joy", "neutral", "sadness", "surprise"]
+
+MAX_TOKENS = 512  # the model's input window
+
+_engines = {}
+_lock = threading.Lock()
+
+
+###################################################################
+#
+# OnnxEmotionEngine:
+#
+# Runs an ONNX export of the emotion model. The model directory
+# holds the .onnx file and the tokenizer.json of the export, e.g.
+#
+#   optimum-cli export onnx --model j-hartmann/emotion-english-distilroberta-base emotion-onnx/
+#   optimum-cli onnxruntime quantize --avx2 --onnx_model emotion-onnx/ -o emotion-onnx/
+#
+# The quantized model (model_quantized.onnx) is used if present,
+# else model.onnx.
+#
+class OnnxEmotionEngine:
+
+  def __init__(self, model_dir, threads=1):
+    import numpy
+    import onnxruntime
+    from tokenizers import Tokenizer
+
+    self._numpy = numpy
+
+    model_dir = pathlib.Path(model_dir)
+
+    model_file = model_dir / "model_quantized.onnx"
+    if not model_file.is_file():
+      model_file = model_dir / "model.onnx"
+
+    #
+    # pin the engine to threads CPU threads, and don't let idle
+    # threads spin (they would burn the Lambda's CPU allowance):
+    #
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    options.add_session_config_entry("session.intra_op.allow_spinning", "0")
+
+    self._session = onnxruntime.InferenceSession(str(model_file), options, providers=["CPUExecutionProvider"])
+    self._inputs = set(i.name for i in self._session.get_inputs())
+
+    self._tokenizer = Tokenizer.from_file(str(model_dir / "tokenizer.json"))
+    self._tokenizer.enable_truncation(max_length=MAX_TOKENS)
+    self._tokenizer.enable_padding()
+
+    self._labels = LABELS
+    config_file = model_dir / "config.json"
+    if config_file.is_file():
+      with open(config_file, "r") as f:
+        id2label = json.load(f).get("id2label")
+      if id2label:
+        self._labels = [id2label[str(i)].lower() for i in range(len(id2label))]
+
+  def classify(self, texts):
+    """Classify a batch of texts; returns a list of label/score lists."""
+    np = self._numpy
+
+    encodings = self._tokenizer.encode_batch(list(texts))
+
+    feeds = {
+      "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+      "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+    }
+    feeds = {name: value for (name, value) in feeds.items() if name in self._inputs}
+
+    logits = self._session.run(None, feeds)[0]
+
+    # softmax, per text:
+    exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+    probs = exp / exp.sum(axis=1, keepdims=True)
+
+    return [_scores(self._labels, row.tolist()) for row in probs]
+
+
+###################################################################
+#
+# LexiconEmotionEngine:
+#
+# Scores a text by the emotion words it contains. Each label's
+# score is its share of the matched words, smoothed towards
+# neutral, so a text with no emotion words is neutral.
+#
+class LexiconEmotionEngine:
+
+  LEXICON = {
+    "anger": "angry anger rage furious mad hate hatred fight yell scream burn fury annoyed bitter hostile",
+    "disgust": "disgust disgusting gross sick nasty vile filthy rotten awful dirty ugly revolting",
+    "fear": "fear afraid scared terror terrified panic dark alone nervous anxious worry dread haunted lost",
+    "joy": "joy happy love smile laugh sun sunshine dance bright glad delight wonderful sweet shine celebrate fun",
+    "sadness": "sad sorrow cry tears lonely broken goodbye miss pain grief gone empty cold hurt blue",
+    "surprise": "surprise surprised sudden suddenly wow amazed shock shocked unexpected wonder astonished",
+  }
+
+  NEUTRAL_WEIGHT = 1.0  # pseudo-count of neutral words per text
+
+  _RE_WORD = re.compile(r"[a-z']+")
+
+  def __init__(self):
+    self._words = {}
+    for (label, words) in self.LEXICON.items():
+      for word in words.split():
+        self._words[word] = label
+
+  def classify(self, texts):
+    """Classify a batch of texts; returns a list of label/score lists."""
+    results = []
+
+    for text in texts:
+      counts = dict.fromkeys(LABELS, 0.0)
+      counts["neutral"] = self.NEUTRAL_WEIGHT
+
+      for word in self._RE_WORD.findall(text.lower()):
+        label = self._words.get(word)
+        if label is not None:
+          counts[label] += 1
+
+      total = sum(counts.values())
+      results.append(_scores(LABELS, [counts[label] / total for label in LABELS]))
+
+    return results
+
+
+def _scores(labels, probs):
+  """label/score list, highest score first, like the Inference API."""
+  scores = [{'label': label, 'score': float(p)} for (label, p) in zip(labels, probs)]
+  scores.sort(key=lambda s: s['score'], reverse=True)
+  return scores
+
+
+###################################################################
+#
+# get_engine:
+#
+# Returns the engine of the given kind, loading it on first use
+# (once per process, per settings).
+#
+def get_engine(kind, model_dir=None, threads=1):
+  """
+  Returns an in-process emotion engine
+
+  Parameters
+  ----------
+  kind : "onnx" or "lexicon",
+  model_dir : directory of the ONNX model (onnx only),
+  threads : # of CPU threads the engine may use (onnx only)
+
+  Returns
+  -------
+  an engine, whose classify(texts) returns a label/score list per
+  text
+  """
+  key = (kind, model_dir, threads)
+
+  with _lock:
+    engine = _engines.get(key)
+    if engine is None:
+      if kind == "onnx":
+        if model_dir is None:
+          raise Exception("emotion_engine: the onnx engine needs a model_dir")
+        engine = OnnxEmotionEngine(model_dir, threads=threads)
+      elif kind == "lexicon":
+        engine = LexiconEmotionEngine()
+      else:
+        raise Exception("emotion_engine: unknown engine '" + str(kind) + "'")
+
+      _engines[key] = engine
+
+    return engine
@@ -0,0 +1,116 @@
+#
+# Archives old jobs: moves completed and errored jobs that
+# finished more than N days ago from the hot jobs table to the
+# cold jobs_archive table. Their songs stay in user_tracks, so
+# they are still in the user's playlists. Run on a schedule (e.g.
+# a daily EventBridge rule); the jobid-based handlers fall back
+# to jobs_archive for archived jobs.
+#
+
+import json
+import datetime
+import bootstrap
+import datatier
+
+ARCHIVE_AFTER_DAYS = 30   # default, see [archive] days in config
+ARCHIVE_BATCH_SIZE = 500  # jobs moved per transaction
+
+def archive_batch(dbConn, cutoff):
+  """
+  Moves up to ARCHIVE_BATCH_SIZE finished jobs that completed
+  before cutoff to jobs_archive in one transaction; returns the #
+  of jobs moved
+  """
+  sql = """
+    SELECT jobid FROM jobs
+     WHERE status IN ('completed', 'error') AND completed_at < %s
+     LIMIT %s;
+  """
+
+  rows = datatier.retrieve_all_rows(dbConn, sql, [cutoff, ARCHIVE_BATCH_SIZE])
+
+  jobids = [row[0] for row in rows]
+  if len(jobids) == 0:
+    return 0
+
+  inlist = "(" + ", ".join(["%s"] * len(jobids)) + ")"
+
+  with datatier.transaction(dbConn):
+    sql = """
+      INSERT INTO jobs_archive(jobid, userid, status, originaldatafile, datafilekey, valence, energy, created_at, completed_at, content_hash)
+        SELECT jobid, userid, status, originaldatafile, datafilekey, valence, energy, created_at, completed_at, content_hash
+          FROM jobs WHERE jobid IN """ + inlist
+    datatier.perform_action(dbConn, sql, jobids)
+
+    sql = "DELETE FROM jobs WHERE jobid IN " + inlist
+    datatier.perform_action(dbConn, sql, jobids)
+
+  return len(jobids)
+
+def lambda_handler(event, context):
+  dbConn = None
+
+  try:
+    print("**STARTING**")
+    print("**lambda: final-project-archive**")
+
+    # set up once per container, see bootstrap.py:
+    configur = bootstrap.get_config()
+    shards = bootstrap.get_shards()
+
+    #
+    # archive jobs finished more than days ago; days can be
+    # overridden in the event:
+    #
+    days = configur.getint('archive', 'days', fallback=ARCHIVE_AFTER_DAYS)
+    if "days" in event:
+      days = int(event["days"])
+
+    #
+    # completed_at is stored in UTC (NOW() on the server):
+    #
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)
+    cutoff = cutoff.strftime("%Y-%m-%d %H:%M:%S")
+
+    print("archiving jobs finished before:", cutoff)
+
+    #
+    # archive each shard, a batch at a time:
+    #
+    archived = 0
+
+    for shard in range(len(shards)):
+      print("**Archiving shard", shard, "**")
+
+      dbConn = shards.get_dbConn(shard)
+
+      while True:
+        n = archive_batch(dbConn, cutoff)
+        archived += n
+        print("archived", n, "jobs")
+        if n < ARCHIVE_BATCH_SIZE:
+          break
+
+      dbConn.close()
+      dbConn = None
+
+    print("**DONE, archived", archived, "jobs**")
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps(archived)
+    }
+
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
+
+  finally:
+    # return the connection to the pool, for the next invocation:
+    if dbConn is not None:
+      dbConn.close()
@@ -4,47 +4,31 @@
 # 
 
 import json
-import boto3
-import os
-import base64
+import bootstrap
 import datatier
-import requests
 
-from configparser import ConfigParser
+#
+# completed jobs never change again, so they can be served from
+# datatier's query cache; jobs in any other status are read fresh,
+# including errored ones, which complete if the upload is retried
+# (SQS redelivers failed uploads, see s3events.py):
+#
+JOB_CACHE_TTL = 300
+
+def job_cache_ttl(row):
+  if row != () and row[2] == "completed":
+    return JOB_CACHE_TTL
+  return 0
 
 def lambda_handler(event, context):
+  dbConn = None
+
   try:
     print("**STARTING**")
     print("**lambda: proj03_download**")
 
-    #
-    # setup AWS based on config file:
-    #
-    config_file = 'musicapp-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
-    
-    #
-    # configure for S3 access:
-    #
-    s3_profile = 's3readwrite'
-    boto3.setup_default_session(profile_name=s3_profile)
-    
-    bucketname = configur.get('s3', 'bucket_name')
-    
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucketname)
-    
-    #
-    # configure for RDS access
-    #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
+    # set up once per container, see bootstrap.py:
+    shards = bootstrap.get_shards()
     
     #
     # jobid from event: could be a parameter
@@ -69,16 +53,42 @@ def lambda_handler(event, context):
     #
     print("**Opening connection**")
     
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    #
+    # the jobid tells us which shard the job is on:
+    #
+    (shard, local_jobid) = datatier.decode_jobid(jobid)
+
+    if shard >= len(shards):  # no such shard => no such job
+      print("**No such job, returning...**")
+      return {
+        'statusCode': 400,
+        'body': json.dumps("no such job...")
+      }
+
+    dbConn = shards.get_dbConn(shard)
 
     #
     # first we need to make sure the userid is valid:
     #
     print("**Checking if jobid is valid**")
     
-    sql = "SELECT * FROM jobs WHERE jobid = %s;"
+    sql = """
+      SELECT jobid, userid, status, originaldatafile, datafilekey, valence, energy
+        FROM jobs WHERE jobid = %s;
+    """
     
-    row = datatier.retrieve_one_row(dbConn, sql, [jobid])
+    row = datatier.retrieve_one_row(dbConn, sql, [local_jobid], ttl=job_cache_ttl)
+
+    if row == ():
+      #
+      # not a current job, but it may have been archived:
+      #
+      sql = """
+        SELECT jobid, userid, status, originaldatafile, datafilekey, valence, energy
+          FROM jobs_archive WHERE jobid = %s;
+      """
+
+      row = datatier.retrieve_one_row(dbConn, sql, [local_jobid], ttl=job_cache_ttl)
     
     if row == ():  # no such job
       print("**No such job, returning...**")
@@ -130,10 +140,12 @@ def lambda_handler(event, context):
       }
     
     #
-    # job is done, return row
+    # job is done, return row (with the global jobid):
     #
     print("**DONE, returning row**")
     
+    row = (datatier.encode_jobid(shard, row[0]),) + tuple(row[1:])
+    
     return {
       'statusCode': 200,
       'body': json.dumps(row)
@@ -149,4 +161,9 @@ def lambda_handler(event, context):
     return {
       'statusCode': 500,
       'body': json.dumps(str(err))
-    }
\ No newline at end of file
+    }
+
+  finally:
+    # return the connection to the pool, for the next invocation:
+    if dbConn is not None:
+      dbConn.close()
@@ -4,36 +4,95 @@
 #
 
 import json
-import boto3
-import os
+import bootstrap
 import datatier
-import requests
 import random
 
-from configparser import ConfigParser
+#
+# songs drawn per seq lookup, per song still needed: > 1 so that
+# a round usually finds enough songs despite gaps in seq:
+#
+PLAYLIST_OVERSAMPLE = 2
+PLAYLIST_MAX_ROUNDS = 8
+
+def distinct_tracks(rows):
+  """
+  Returns one of the rows of each track, picked at random (a track
+  recommended to the user for several jobs has several rows)
+  """
+  rows = list(rows)
+  random.shuffle(rows)
+  return list({row[0]: row for row in rows}.values())
+
+def sample_songs(dbConn, userid, lo, hi, length):
+  """
+  Returns a random sample of at most length of the user's songs,
+  each track once, whose seq values lie in [lo, hi] (lo is None if
+  the user has no songs; the sample is then [])
+  """
+  if lo is None or length <= 0:
+    return []
+
+  columns = """
+    SELECT ut.trackid, ut.userid, ut.jobid, t.trackname, t.trackartist
+      FROM user_tracks ut JOIN tracks t ON t.trackid = ut.trackid
+  """
+
+  #
+  # few songs: reading them all is as cheap as looking them up:
+  #
+  span = hi - lo + 1
+  if span <= PLAYLIST_OVERSAMPLE * length * PLAYLIST_MAX_ROUNDS:
+    rows = distinct_tracks(datatier.retrieve_all_rows(dbConn, columns + " WHERE ut.userid = %s", [userid]))
+    return random.sample(rows, min(length, len(rows)))
+
+  rows = []
+  tried = set()
+
+  for _ in range(PLAYLIST_MAX_ROUNDS):
+    needed = length - len(rows)
+    if needed == 0:
+      break
+
+    #
+    # distinct seq values not drawn before; the span is larger
+    # than all the rounds draw together, so this terminates:
+    #
+    seqs = set()
+    while len(seqs) < PLAYLIST_OVERSAMPLE * needed:
+      seq = random.randint(lo, hi)
+      if seq not in tried:
+        seqs.add(seq)
+    tried |= seqs
+
+    sql = columns + " WHERE ut.userid = %s AND ut.seq IN (" + ", ".join(["%s"] * len(seqs)) + ")"
+    found = distinct_tracks(datatier.retrieve_all_rows(dbConn, sql, [userid] + list(seqs)))
+
+    sampled = set(row[0] for row in rows)
+    found = [row for row in found if row[0] not in sampled]
+
+    rows += random.sample(found, min(needed, len(found)))
+
+  if len(rows) < length:
+    #
+    # seq is mostly gaps: fall back to reading all the user's
+    # songs
+    #
+    print("**Sparse seq, sampling all songs**")
+    rows = distinct_tracks(datatier.retrieve_all_rows(dbConn, columns + " WHERE ut.userid = %s", [userid]))
+    rows = random.sample(rows, min(length, len(rows)))
+
+  return rows
 
 def lambda_handler(event, context):
+  dbConn = None
+
   try:
     print("**STARTING**")
     print("**lambda: proj03_jobs**")
     
-    #
-    # setup AWS based on config file:
-    #
-    config_file = 'musicapp-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
-    
-    #
-    # configure for RDS access
-    #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
+    # set up once per container, see bootstrap.py:
+    shards = bootstrap.get_shards()
 
     #
     # get userid to search songs for
@@ -54,7 +113,12 @@ def lambda_handler(event, context):
     #
     print("**Opening connection**")
     
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    #
+    # the user's data lives on the user's shard:
+    #
+    shard = shards.shard_for_user(userid)
+
+    dbConn = shards.get_dbConn(shard)
 
     #
     # check if this user exists
@@ -70,12 +134,12 @@ def lambda_handler(event, context):
     if "length" in event:
       length = int(event["length"])
     elif event.get("queryStringParameters"):  # Ensures it's not None
-      length = event["queryStringParameters"].get("length")  # Get length safely
+      length = int(event["queryStringParameters"].get("length", length))  # Get length safely
     print("length: ", length)
 
     sql = "SELECT * FROM users WHERE userid = %s"
     
-    row = datatier.retrieve_one_row(dbConn, sql, [userid])
+    row = datatier.retrieve_one_row(dbConn, sql, [userid], ttl=bootstrap.user_cache_ttl)
     if row == ():  # no such user
       print("**No such user, returning...**")
       return {
@@ -88,21 +152,27 @@ def lambda_handler(event, context):
     #
     print("**Retrieving song data for user**")
     
-    sql = "SELECT * FROM songs WHERE userid = %s ORDER BY songname"
-    
-    rows = datatier.retrieve_all_rows(dbConn, sql, [userid])
-    
-    for row in rows:
-      print(row)
-
     #
-    # Randomize songs
+    # Randomize songs: a user's songs are numbered seq = 1, 2,
+    # 3, ... (possibly with gaps), so a uniform random sample is a
+    # set of distinct random seq values between the user's lowest
+    # and highest, looked up on the (userid, seq) index; values
+    # that land in a gap are drawn again. Shuffling the sample
+    # gives the same result as shuffling every song and keeping
+    # the first length of them, without reading them all. A track
+    # recommended for several jobs is in the playlist once.
     #
     print("**Randomizing songs**")
-    rows = list(rows)
+
+    sql = "SELECT MIN(seq), MAX(seq) FROM user_tracks WHERE userid = %s"
+    (lo, hi) = datatier.retrieve_one_row(dbConn, sql, [userid])
+
+    rows = sample_songs(dbConn, userid, lo, hi, length)
+
     random.shuffle(rows)
-    if length < len(rows):
-      rows = rows[:length]
+
+    # report global jobids:
+    rows = [row[:2] + (datatier.encode_jobid(shard, row[2]),) + tuple(row[3:]) for row in rows]
 
     for row in rows:
       print("Song name: " + row[3] + " | Song artist: " + row[4])
@@ -126,3 +196,8 @@ def lambda_handler(event, context):
       'statusCode': 500,
       'body': json.dumps(str(err))
     }
+
+  finally:
+    # return the connection to the pool, for the next invocation:
+    if dbConn is not None:
+      dbConn.close()
@@ -5,48 +5,25 @@
 # 
 
 import json
-import boto3
-import os
-import base64
+import bootstrap
 import datatier
-import requests
 import spotify
 
-from configparser import ConfigParser
+#
+# longest track name / artist stored, see the tracks table:
+#
+TRACK_NAME_MAX = 256
 
 def lambda_handler(event, context):
+  dbConn = None
+
   try:
     print("**STARTING**")
     print("**lambda: proj03_download**")
 
-    #
-    # setup AWS based on config file:
-    #
-    config_file = 'musicapp-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
-    
-    #
-    # configure for S3 access:
-    #
-    s3_profile = 's3readwrite'
-    boto3.setup_default_session(profile_name=s3_profile)
-    
-    bucketname = configur.get('s3', 'bucket_name')
-    
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucketname)
-    
-    #
-    # configure for RDS access
-    #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
+    # set up once per container, see bootstrap.py:
+    configur = bootstrap.get_config()
+    shards = bootstrap.get_shards()
 
     #
     # configure for Spotify token
@@ -77,16 +54,42 @@ def lambda_handler(event, context):
     #
     print("**Opening connection**")
     
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    #
+    # the jobid tells us which shard the job is on:
+    #
+    (shard, local_jobid) = datatier.decode_jobid(jobid)
+
+    if shard >= len(shards):  # no such shard => no such job
+      print("**No such job, returning...**")
+      return {
+        'statusCode': 400,
+        'body': json.dumps("no such job...")
+      }
+
+    dbConn = shards.get_dbConn(shard)
 
     #
     # first we need to make sure the userid is valid:
     #
     print("**Checking if jobid is valid**")
     
-    sql = "SELECT * FROM jobs WHERE jobid = %s;"
+    sql = """
+      SELECT jobid, userid, status, originaldatafile, datafilekey, valence, energy
+        FROM jobs WHERE jobid = %s;
+    """
     
-    row = datatier.retrieve_one_row(dbConn, sql, [jobid])
+    row = datatier.retrieve_one_row(dbConn, sql, [local_jobid])
+
+    if row == ():
+      #
+      # not a current job, but it may have been archived:
+      #
+      sql = """
+        SELECT jobid, userid, status, originaldatafile, datafilekey, valence, energy
+          FROM jobs_archive WHERE jobid = %s;
+      """
+
+      row = datatier.retrieve_one_row(dbConn, sql, [local_jobid])
     
     if row == ():  # no such job
       print("**No such job, returning...**")
@@ -156,8 +159,8 @@ def lambda_handler(event, context):
     print("**Getting Spotify token...**")
     AUTH_URL = 'https://accounts.spotify.com/api/token'
 
-    # POST
-    auth_response = requests.post(AUTH_URL, {
+    # POST, on the shared keep-alive session (see bootstrap.py)
+    auth_response = bootstrap.get_http_session().post(AUTH_URL, {
       'grant_type': 'client_credentials',
       'client_id': spotify_id,
       'client_secret': spotify_secret,
@@ -196,10 +199,55 @@ def lambda_handler(event, context):
     print("Songs: ", songs)
 
     print("**Adding songs to database...**")
-    for song in songs:
-      sql = '''INSERT INTO songs(userid, jobid, songname, songartist)
-                           values(%s, %s, %s, %s);'''
-      row = datatier.perform_action(dbConn, sql, [userid, jobid, song[0], song[1]])
+    #
+    # one transaction for all the songs (of a current or an
+    # archived job):
+    #
+    with datatier.transaction(dbConn):
+      #
+      # add the songs to the track catalog, skipping tracks already
+      # there (recommended before, to anyone), then look up the
+      # tracks' ids; FOR SHARE reads the latest committed tracks,
+      # including ones a concurrent request just added:
+      #
+      tracks = list(dict.fromkeys((song[0].strip()[:TRACK_NAME_MAX], song[1].strip()[:TRACK_NAME_MAX]) for song in songs))
+
+      sql = '''INSERT IGNORE INTO tracks(trackname, trackartist)
+                           values(%s, %s)'''
+      datatier.perform_action_many(dbConn, sql, [list(track) for track in tracks])
+
+      names = sorted(set(track[0] for track in tracks))
+      sql = "SELECT trackid, trackname, trackartist FROM tracks WHERE trackname IN (" + ", ".join(["%s"] * len(names)) + ") FOR SHARE"
+      rows = datatier.retrieve_all_rows(dbConn, sql, names)
+      trackids = {(row[1], row[2]): row[0] for row in rows}
+
+      #
+      # number the tracks after the user's last one (seq, used by
+      # the playlist to sample songs); FOR UPDATE locks the user's
+      # numbering until commit, so concurrent requests for the same
+      # user take turns:
+      #
+      sql = "SELECT COALESCE(MAX(seq), 0) FROM user_tracks WHERE userid = %s FOR UPDATE"
+      row = datatier.retrieve_one_row(dbConn, sql, [userid])
+      lastseq = row[0]
+
+      #
+      # skip tracks this job already recommended on an earlier
+      # call (FOR SHARE: as of the latest commit):
+      #
+      sql = "SELECT trackid FROM user_tracks WHERE jobid = %s FOR SHARE"
+      existing = set(row[0] for row in datatier.retrieve_all_rows(dbConn, sql, [local_jobid]))
+
+      newids = [trackid for trackid in dict.fromkeys(trackids[track] for track in tracks) if trackid not in existing]
+
+      #
+      # one multi-row INSERT for all the new tracks (a plain
+      # INSERT, so e.g. a foreign key error is not ignored):
+      #
+      if len(newids) > 0:
+        sql = '''INSERT INTO user_tracks(userid, seq, jobid, trackid)
+                             values(%s, %s, %s, %s)'''
+        datatier.perform_action_many(dbConn, sql, [[userid, lastseq + 1 + i, local_jobid, trackid] for (i, trackid) in enumerate(newids)])
 
     print("**DONE**")
     print("**Returning songs to client...")
@@ -219,4 +267,8 @@ def lambda_handler(event, context):
       'statusCode': 500,
       'body': json.dumps(str(err))
     }
-    
+
+  finally:
+    # return the connection to the pool, for the next invocation:
+    if dbConn is not None:
+      dbConn.close()
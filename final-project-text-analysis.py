@@ -1,62 +1,25 @@
 # Python program to open and process a txt file.
 # Call hugging face inference API and perform computations
 # to get valence and energy scores for Spotify API, and save
-# the results to a text file.
+# the results to the database. Files of any size are streamed
+# from S3 and classified in chunks, and every upload in a batch
+# is analyzed concurrently (see s3events.py).
 
 import json
-import boto3
-import os
 import pathlib
+import bootstrap
 import datatier
-import urllib.parse
 import emotion
+import s3events
 
-from configparser import ConfigParser
-
-def lambda_handler(event, context):
+#
+# analyzes one uploaded TXT, start to finish, and returns None on
+# success or the error message; runs on a worker thread, one per
+# upload in the batch, and uses a database connection only for the
+# job's queries
+#
+def analyze(bucketkey, s3, bucketname, shards, hf_api_key, hf_concurrency, engine):
   try:
-    print("**STARTING**")
-    print("**lambda: proj03_compute**")
-    
-    #
-    # setup AWS based on config file:
-    #
-    config_file = 'musicapp-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
-    
-    #
-    # configure for S3 access:
-    #
-    s3_profile = 's3readwrite'
-    boto3.setup_default_session(profile_name=s3_profile)
-    
-    bucketname = configur.get('s3', 'bucket_name')
-    
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucketname)
-    
-    #
-    # configure for RDS access
-    #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
-
-    # configure for hugging face access:
-    hf_api_key = configur.get('hf', 'api_key')
-
-    #
-    # this function is event-driven by a TXT being
-    # dropped into S3. The bucket key is sent to 
-    # us and obtain as follows:
-    #
-    bucketkey = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
-    
     print("bucketkey:", bucketkey)
       
     extension = pathlib.Path(bucketkey).suffix
@@ -65,86 +28,133 @@ def lambda_handler(event, context):
       raise Exception("expecting S3 document to have .txt extension")
 
     #
-    # download TXT from S3 to LOCAL file system:
+    # the TXT's SHA-256 (S3's checksum of the upload), to
+    # recognize a file analyzed before:
     #
-    print("**DOWNLOADING '", bucketkey, "'**")
+    print("**Getting content hash**")
+    content_hash = s3events.content_sha256(s3, bucketname, bucketkey)
 
-    #
-    # download file to local system
-    #
-    local_txt = "/tmp/data.txt"
-    
-    bucket.download_file(bucketkey, local_txt)
-
-    #
-    # open LOCAL pdf file:
-    #
-    print("**PROCESSING local TXT**")
-    input_text = ''
-    with open(local_txt, 'r') as f:
-      input_text = f.read()
-    
-    print(input_text)
     #
     # update status column in DB for this job
     #
     print("**Opening DB connection**")
     #
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
-    #
-    sql = "Update jobs Set status = %s Where datafilekey = %s"
-    datatier.perform_action(dbConn, sql, ["processing - starting", bucketkey])
+    with s3events.job_dbConn(shards, bucketkey) as dbConn:
+      sql = "Update jobs Set status = %s, content_hash = %s Where datafilekey = %s"
+      datatier.perform_action(dbConn, sql, ["processing - starting", content_hash, bucketkey])
 
-    #
-    # call huggingface inference API to get emotion scores
-    #
-    emotion_scores = emotion.get_emotion_scores(input_text, hf_api_key)
-    
-    #
-    # convert emotion scores to valence energy scores
-    #
-    ve_scores = emotion.map_emotions_to_valence_energy(emotion_scores)
-    #
-    valence = ve_scores[0]
-    energy = ve_scores[1]
+      prior = s3events.prior_result(dbConn, content_hash, bucketkey)
+
+    if prior is not None:
+      print("**Same file analyzed before, reusing result**")
+      (valence, energy) = prior
+    else:
+      #
+      # call huggingface inference API to get emotion scores:
+      # the TXT is streamed from S3 and classified in chunks that
+      # fit the model's input, several at a time
+      #
+      print("**Classifying TXT in chunks**")
+      body = s3.get_object(Bucket=bucketname, Key=bucketkey)['Body']
+
+      emotion_scores = emotion.get_emotion_scores_chunked(body, hf_api_key, concurrency=hf_concurrency, engine=engine)
+      if emotion_scores is None:
+        raise Exception("TXT file has no text to analyze")
+
+      #
+      # convert emotion scores to valence energy scores
+      #
+      ve_scores = emotion.map_emotions_to_valence_energy(emotion_scores)
+      #
+      valence = ve_scores[0]
+      energy = ve_scores[1]
 
     #
     # analysis complete, update the database to change
     # the status of this job, and store the results
     #
     print("**Updating DB with result**")
-    sql = "Update jobs Set status = %s, valence = %s, energy = %s Where datafilekey = %s"
-    datatier.perform_action(dbConn, sql, ["completed", str(valence), str(energy), bucketkey])
-    print("**DONE, returning success**")
-    
-    return {
-      'statusCode': 200,
-      'body': json.dumps("success")
-    }
+    with s3events.job_dbConn(shards, bucketkey) as dbConn:
+      sql = "Update jobs Set status = %s, valence = %s, energy = %s, completed_at = NOW() Where datafilekey = %s"
+      datatier.perform_action(dbConn, sql, ["completed", str(valence), str(energy), bucketkey])
+    print("**DONE:", bucketkey, "**")
+
+    return None
   
   #
   # on an error, try to upload error message to database:
   #
   except Exception as err:
-    print("**ERROR**")
+    print("**ERROR**", bucketkey)
     print(str(err))
     
     #
     # update jobs row in database:
     #
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    try:
+      with s3events.job_dbConn(shards, bucketkey) as dbConn:
+        sql = "Update jobs Set status = %s, completed_at = NOW() Where datafilekey = %s"
+        datatier.perform_action(dbConn, sql, ["error", bucketkey])
+
+    except Exception as err2:
+      print("**ERROR** updating job status of", bucketkey)
+      print(str(err2))
+
+    return str(err)
+
+def lambda_handler(event, context):
+  try:
+    print("**STARTING**")
+    print("**lambda: proj03_compute**")
+    
+    # set up once per container, see bootstrap.py (the S3 client is thread-safe):
+    configur = bootstrap.get_config()
+    s3 = bootstrap.get_s3_client()
+    bucketname = configur.get('s3', 'bucket_name')
+    shards = bootstrap.get_shards()
+
+    # configure for hugging face access:
+    hf_api_key = configur.get('hf', 'api_key', fallback=None)
+    hf_concurrency = configur.getint('hf', 'concurrency', fallback=emotion.EMOTION_CONCURRENCY)
+
+    #
+    # optionally, classify in-process instead of calling the
+    # Inference API (see emotion_engine.py); loaded once per
+    # container:
     #
-    sql = "Update jobs Set status = %s Where datafilekey = %s"
-    datatier.perform_action(dbConn, sql, ["error", bucketkey])
+    engine = None
+    engine_kind = configur.get('emotion', 'engine', fallback='hf')
+
+    if engine_kind != 'hf':
+      import emotion_engine
+
+      engine = emotion_engine.get_engine(engine_kind,
+                                         model_dir=configur.get('emotion', 'model_dir', fallback=None),
+                                         threads=configur.getint('emotion', 'threads', fallback=1))
+
+    #
+    # this function is event-driven by TXTs being dropped into
+    # S3, one or more per event (directly, or through an SQS
+    # queue); each is analyzed on its own worker thread:
     #
+    concurrency = configur.getint('analysis', 'concurrency', fallback=s3events.RECORD_CONCURRENCY)
 
+    response = s3events.process_records(event,
+                                        lambda bucketkey: analyze(bucketkey, s3, bucketname, shards, hf_api_key, hf_concurrency, engine),
+                                        concurrency=concurrency)
+
+    #
+    # emotion score cache counters (per container), to size it:
     #
-    # done, return:
-    #    
+    print("**Emotion cache:", json.dumps(emotion.get_cache_stats()), "**")
+
+    return response
+  
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+
     return {
       'statusCode': 500,
       'body': json.dumps(str(err))
     }
-
-
-
@@ -0,0 +1,206 @@
+#
+# Step 1 of a direct-to-S3 upload: inserts a new job record in
+# the MusicApp database with a status of 'uploaded', and sends the
+# job id back to the client with a presigned URL. The client then
+# PUTs the raw file to that URL (step 2), straight to S3, instead
+# of sending it base64-encoded through API Gateway and
+# final-project-upload.py. S3 triggers the analysis handlers as
+# for any other upload.
+#
+# The client may also send the file's SHA-256 (hex); it is then
+# signed into the URL, so S3 rejects a PUT of other content and
+# stores it as the object's checksum, which the analysis handlers
+# read instead of hashing the file.
+#
+
+import base64
+import json
+import re
+import uuid
+import pathlib
+import bootstrap
+import datatier
+
+UPLOAD_URL_EXPIRES = 900  # seconds the presigned URL is valid
+
+CONTENT_TYPES = {".txt": "text/plain", ".jpg": "image/jpeg"}
+
+_RE_SHA256 = re.compile(r"[0-9a-fA-F]{64}")
+
+def lambda_handler(event, context):
+  dbConn = None
+
+  try:
+    print("**STARTING**")
+    print("**lambda: final-project-upload-url**")
+
+    # set up once per container, see bootstrap.py:
+    configur = bootstrap.get_config()
+    shards = bootstrap.get_shards()
+
+    #
+    # userid from event: could be a parameter
+    # or could be part of URL path ("pathParameters"):
+    #
+    print("**Accessing event/pathParameters**")
+
+    if "userid" in event:
+      userid = event["userid"]
+    elif "pathParameters" in event:
+      if "userid" in event["pathParameters"]:
+        userid = event["pathParameters"]["userid"]
+      else:
+        raise Exception("requires userid parameter in pathParameters")
+    else:
+      raise Exception("requires userid parameter in event")
+
+    print("userid:", userid)
+
+    #
+    # the user has sent us the filename of their file, in the
+    # body of the request in JSON format (the file itself goes
+    # straight to S3):
+    #
+    print("**Accessing request body**")
+
+    if "body" not in event:
+      raise Exception("event has no body")
+
+    body = json.loads(event["body"]) # parse the json
+
+    if "filename" not in body:
+      raise Exception("event has a body but no filename")
+
+    filename = body["filename"]
+
+    print("filename:", filename)
+
+    sha256 = body.get("sha256")  # optional
+
+    if sha256 is not None and _RE_SHA256.fullmatch(sha256) is None:
+      return {
+        'statusCode': 400,
+        'body': json.dumps("sha256 must be 64 hex digits")
+      }
+
+    #
+    # only TXT and JPG files are analyzed:
+    #
+    extension = pathlib.Path(filename).suffix.lower()
+    if extension not in CONTENT_TYPES:
+      return {
+        'statusCode': 400,
+        'body': json.dumps("Only .txt and .jpg files are allowed")
+      }
+
+    #
+    # open connection to the database:
+    #
+    print("**Opening connection**")
+
+    #
+    # the user's data lives on the user's shard:
+    #
+    shard = shards.shard_for_user(userid)
+
+    dbConn = shards.get_dbConn(shard)
+
+    #
+    # first we need to make sure the userid is valid:
+    #
+    print("**Checking if userid is valid**")
+
+    sql = "SELECT * FROM users WHERE userid = %s;"
+
+    row = datatier.retrieve_one_row(dbConn, sql, [userid], ttl=bootstrap.user_cache_ttl)
+
+    if row == ():  # no such user
+      print("**No such user, returning...**")
+      return {
+        'statusCode': 400,
+        'body': json.dumps("no such user...")
+      }
+
+    username = row[1]
+
+    #
+    # generate unique filename for the S3 upload:
+    #
+    basename = pathlib.Path(filename).stem
+
+    # (jobs on shards other than 0 record their shard in the key)
+    bucketkey = "musicapp/" + shards.bucketkey_tag(shard) + username + "/" + basename + "-" + str(uuid.uuid4()) + extension
+
+    print("S3 bucketkey:", bucketkey)
+
+    #
+    # insert job into database with status uploaded
+    #
+    print("**Adding jobs row to database**")
+
+    sql = """
+      INSERT INTO jobs(userid, status, originaldatafile, datafilekey)
+                  VALUES(%s, %s, %s, %s);
+    """
+
+    local_jobid = datatier.perform_action(dbConn, sql, [userid, "uploaded", filename, bucketkey], lastrowid=True)
+
+    jobid = datatier.encode_jobid(shard, local_jobid)  # global jobid
+
+    print("jobid:", jobid)
+
+    #
+    # presign a PUT of the file; the client must send the signed
+    # headers with the same values:
+    #
+    print("**Presigning upload URL**")
+
+    headers = {
+      'Content-Type': CONTENT_TYPES[extension],
+      'x-amz-acl': 'public-read'
+    }
+
+    params = {
+      'Bucket': configur.get('s3', 'bucket_name'),
+      'Key': bucketkey,
+      'ContentType': headers['Content-Type'],
+      'ACL': headers['x-amz-acl']
+    }
+
+    if sha256 is not None:
+      headers['x-amz-checksum-sha256'] = base64.b64encode(bytes.fromhex(sha256)).decode()
+      params['ChecksumSHA256'] = headers['x-amz-checksum-sha256']
+
+    s3 = bootstrap.get_s3_client()
+
+    url = s3.generate_presigned_url('put_object', Params=params, ExpiresIn=UPLOAD_URL_EXPIRES)
+
+    #
+    # respond in an HTTP-like way, i.e. with a status
+    # code and body in JSON format:
+    #
+    print("**DONE, returning jobid and upload URL**")
+
+    return {
+      'statusCode': 200,
+      'body': json.dumps({
+        'jobid': str(jobid),
+        'url': url,
+        'headers': headers,
+        'expires_in': UPLOAD_URL_EXPIRES
+      })
+    }
+
+  except Exception as err:
+    print("**ERROR**")
+    print(str(err))
+
+    return {
+      'statusCode': 500,
+      'body': json.dumps(str(err))
+    }
+
+  finally:
+    # return the connection to the pool, for the next invocation:
+    if dbConn is not None:
+      dbConn.close()
@@ -5,48 +5,100 @@
 #
 
 import json
-import boto3
-import os
 import uuid
 import base64
 import pathlib
+import re
+import bootstrap
 import datatier
 
-from configparser import ConfigParser
+#
+# the decoded file is streamed to S3 (multipart above one part),
+# UPLOAD_PART_SIZE bytes at a time with up to UPLOAD_CONCURRENCY
+# parts in flight, so memory stays bounded whatever the file size:
+#
+UPLOAD_PART_SIZE = 8 * 1024 * 1024
+UPLOAD_CONCURRENCY = 4
+DECODE_CHUNK = 1024 * 1024  # base64 chars decoded at a time
+
+CONTENT_TYPES = {".txt": "text/plain", ".jpg": "image/jpeg"}
+
+#
+# base64 alphabet, padding at the end only; whitespace (e.g. line
+# breaks) is ignored, as Base64Reader does:
+#
+_BASE64_WHITESPACE = " \t\r\n"
+_RE_BASE64 = re.compile(r"[A-Za-z0-9+/ \t\r\n]*(=[ \t\r\n]*){0,2}")
+
+def is_base64(datastr):
+  """
+  Returns True if datastr is well-formed base64, checked without
+  decoding or copying it
+  """
+  if _RE_BASE64.fullmatch(datastr) is None:
+    return False
+  nchars = len(datastr) - sum(datastr.count(c) for c in _BASE64_WHITESPACE)
+  return nchars % 4 == 0
+
+class Base64Reader:
+  """
+  Read-only file object over a base64 string that decodes the
+  string a chunk at a time as it is read, instead of all at once
+  """
+
+  def __init__(self, datastr):
+    self._data = datastr
+    self._pos = 0        # next char of datastr to decode
+    self._pending = ""   # chars carried over to complete a 4-char group
+    self._buffer = b""   # decoded bytes not yet read
+
+  def _at_end(self):
+    return self._pos >= len(self._data) and self._pending == ""
+
+  def _decode_more(self):
+    chunk = self._data[self._pos:self._pos + DECODE_CHUNK]
+    self._pos += len(chunk)
+
+    # like b64decode, ignore whitespace (e.g. line breaks):
+    chunk = self._pending + "".join(chunk.split())
+
+    if self._pos >= len(self._data):  # last chunk, decode it all
+      n = len(chunk)
+    else:
+      n = len(chunk) - len(chunk) % 4
+
+    self._pending = chunk[n:]
+    return base64.b64decode(chunk[:n])
+
+  def read(self, size=-1):
+    parts = [self._buffer]
+    have = len(self._buffer)
+
+    while (size is None or size < 0 or have < size) and not self._at_end():
+      decoded = self._decode_more()
+      parts.append(decoded)
+      have += len(decoded)
+
+    data = b"".join(parts)
+
+    if size is None or size < 0:
+      self._buffer = b""
+      return data
+
+    self._buffer = data[size:]
+    return data[:size]
 
 def lambda_handler(event, context):
+  dbConn = None
+  local_jobid = None
+
   try:
     print("**STARTING**")
     print("**lambda: proj03_upload**")
     
-    #
-    # setup AWS based on config file:
-    #
-    config_file = 'musicapp-config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-    
-    configur = ConfigParser()
-    configur.read(config_file)
-    
-    #
-    # configure for S3 access:
-    #
-    s3_profile = 's3readwrite'
-    boto3.setup_default_session(profile_name=s3_profile)
-    
-    bucketname = configur.get('s3', 'bucket_name')
-    
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucketname)
-    
-    #
-    # configure for RDS access
-    #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
+    # set up once per container, see bootstrap.py:
+    bucket = bootstrap.get_bucket()
+    shards = bootstrap.get_shards()
     
     #
     # userid from event: could be a parameter
@@ -93,12 +145,27 @@ def lambda_handler(event, context):
     print("filename:", filename)
     print("datastr (first 10 chars):", datastr[0:10])
 
+    #
+    # the file is decoded only as it is uploaded, after the job is
+    # created, so reject malformed data now:
+    #
+    if not is_base64(datastr):
+      return {
+        'statusCode': 400,
+        'body': json.dumps("data is not valid base64")
+      }
+
     #
     # open connection to the database:
     #
     print("**Opening connection**")
     
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    #
+    # the user's data lives on the user's shard:
+    #
+    shard = shards.shard_for_user(userid)
+
+    dbConn = shards.get_dbConn(shard)
 
     #
     # first we need to make sure the userid is valid:
@@ -107,7 +174,7 @@ def lambda_handler(event, context):
     
     sql = "SELECT * FROM users WHERE userid = %s;"
     
-    row = datatier.retrieve_one_row(dbConn, sql, [userid])
+    row = datatier.retrieve_one_row(dbConn, sql, [userid], ttl=bootstrap.user_cache_ttl)
     
     if row == ():  # no such user
       print("**No such user, returning...**")
@@ -121,30 +188,20 @@ def lambda_handler(event, context):
     username = row[1]
     
     #
-    # at this point the user exists, so safe to upload to S3:
+    # at this point the user exists, so safe to upload to S3;
+    # only TXT and JPG files are analyzed:
     #
-    base64_bytes = datastr.encode()        # string -> base64 bytes
-    bytes = base64.b64decode(base64_bytes) # base64 bytes -> raw bytes
-    
-    # Determine file extension
     extension = pathlib.Path(filename).suffix.lower()
-    if extension not in [".txt", ".jpg"]:
+    if extension not in CONTENT_TYPES:
       raise Exception("Only .txt and .jpg files are allowed")
-    
-    # Write raw bytes to local filesystem
-    print("**Writing local data file**")
-    local_filename = f"/tmp/data{extension}"
-    with open(local_filename, "wb") as f:
-      f.write(bytes)
 
     #
     # generate unique filename in preparation for the S3 upload:
     #
-    print("**Uploading local file to S3**")
-    
     basename = pathlib.Path(filename).stem
     
-    bucketkey = "musicapp/" + username + "/" + basename + "-" + str(uuid.uuid4()) + extension
+    # (jobs on shards other than 0 record their shard in the key)
+    bucketkey = "musicapp/" + shards.bucketkey_tag(shard) + username + "/" + basename + "-" + str(uuid.uuid4()) + extension
     
     print("S3 bucketkey:", bucketkey)
 
@@ -158,30 +215,33 @@ def lambda_handler(event, context):
                   VALUES(%s, %s, %s, %s);
     """
     
-    datatier.perform_action(dbConn, sql, [userid, "uploaded", filename, bucketkey])
-
-    #
-    # grab the jobid that was auto-generated by mysql:
-    #
-    sql = "SELECT LAST_INSERT_ID();"
-    
-    row = datatier.retrieve_one_row(dbConn, sql)
+    # insert and grab the jobid that was auto-generated by mysql:
+    local_jobid = datatier.perform_action(dbConn, sql, [userid, "uploaded", filename, bucketkey], lastrowid=True)
     
-    jobid = row[0]
+    jobid = datatier.encode_jobid(shard, local_jobid)  # global jobid
     
     print("jobid:", jobid)
 
     #
-    # now that DB is updated, let's upload PDF to S3:
+    # now that DB is updated, stream the file to S3, decoding
+    # the base64 data as it goes:
     #
     print("**Uploading data file to S3**")
 
-    bucket.upload_file(local_filename, 
-                       bucketkey, 
-                       ExtraArgs={
-                         'ACL': 'public-read',
-                         'ContentType': 'application/pdf'
-                       })
+    from boto3.s3.transfer import TransferConfig  # boto3 is loaded by bootstrap.get_bucket()
+
+    config = TransferConfig(multipart_threshold=UPLOAD_PART_SIZE,
+                            multipart_chunksize=UPLOAD_PART_SIZE,
+                            max_concurrency=UPLOAD_CONCURRENCY)
+
+    bucket.upload_fileobj(Base64Reader(datastr),
+                          bucketkey,
+                          ExtraArgs={
+                            'ACL': 'public-read',
+                            'ContentType': CONTENT_TYPES[extension],
+                            'ChecksumAlgorithm': 'SHA256'  # the analysis reads it, see s3events.content_sha256
+                          },
+                          Config=config)
     
     #
     # respond in an HTTP-like way, i.e. with a status
@@ -197,8 +257,25 @@ def lambda_handler(event, context):
   except Exception as err:
     print("**ERROR**")
     print(str(err))
+
+    #
+    # if the job was created but the upload failed, the job will
+    # never be analyzed; mark it:
+    #
+    if local_jobid is not None:
+      try:
+        sql = "Update jobs Set status = %s, completed_at = NOW() Where jobid = %s"
+        datatier.perform_action(dbConn, sql, ["error", local_jobid])
+      except Exception as err2:
+        print("**ERROR** updating job status")
+        print(str(err2))
     
     return {
       'statusCode': 500,
       'body': json.dumps(str(err))
     }
+
+  finally:
+    # return the connection to the pool, for the next invocation:
+    if dbConn is not None:
+      dbConn.close()
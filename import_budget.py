@@ -0,0 +1,172 @@
+#
+# import_budget.py
+#
+# Measures the cold-start import time of each Lambda handler: the
+# time a fresh interpreter spends importing final-project-*.py
+# and everything it imports, as reported by python -X importtime.
+# Fails if a handler goes over its budget, so a heavy import added
+# at module level (instead of lazily, where it is used) is caught.
+#
+# Usage:
+#   python import_budget.py [--runs N] [config_file]
+#
+# Budgets, in milliseconds, are read from the optional
+# import_budget section of the config file (which defaults to
+# musicapp-config.ini), e.g.
+#
+#   [import_budget]
+#   default = 150
+#   final-project-songrec.py = 200
+#
+# Each handler is imported N times (default 5), after one
+# discarded run that compiles its .pyc files, and the median is
+# compared to the budget. The handler's slowest direct imports
+# are listed, to show what to make lazy.
+#
+
+import pathlib
+import subprocess
+import sys
+
+from configparser import ConfigParser
+
+
+HANDLERS_DIR = pathlib.Path(__file__).parent
+
+DEFAULT_BUDGET_MS = 150
+DEFAULT_RUNS = 5
+TOP_IMPORTS = 3  # slowest direct imports listed per handler
+
+
+###################################################################
+#
+# import_times:
+#
+# Imports the handler in a fresh interpreter with -X importtime,
+# and returns its cumulative import time and those of its direct
+# imports.
+#
+def import_times(handler):
+  """
+  Imports a handler in a new python process and parses the
+  -X importtime report
+
+  Parameters
+  ----------
+  handler : the handler's file name, e.g. final-project-upload.py
+
+  Returns
+  -------
+  (total_us, [(cumulative_us, module), ...]) for the handler and
+  each module it imports directly
+  """
+  module = pathlib.Path(handler).stem
+
+  #
+  # __import__ rather than importlib.import_module, which
+  # importtime does not report (the module name has hyphens, so
+  # an import statement cannot be used):
+  #
+  cmd = [sys.executable, "-X", "importtime", "-c", "__import__(%r)" % module]
+  result = subprocess.run(cmd, cwd=HANDLERS_DIR, capture_output=True, text=True)
+
+  if result.returncode != 0:
+    raise Exception(handler + " failed to import: " + result.stderr.strip().splitlines()[-1])
+
+  #
+  # lines are "import time: <self us> | <cumulative us> | <module>",
+  # with the module indented 2 spaces per level of nesting; a
+  # module's line follows those of the modules it imports:
+  #
+  total = None
+  children = []
+  imports = []
+
+  for line in result.stderr.splitlines():
+    parts = line[len("import time:"):].split("|")
+    if not line.startswith("import time:") or len(parts) != 3 or not parts[1].strip().isdigit():
+      continue
+
+    cumulative = int(parts[1])
+    name = parts[2].rstrip()
+    level = (len(name) - len(name.lstrip()) - 1) // 2
+    name = name.strip()
+
+    if level == 1:
+      children.append((cumulative, name))
+    elif level == 0:
+      if name == module:
+        total = cumulative
+        imports = children
+      children = []
+
+  if total is None:
+    raise Exception("no -X importtime report for " + handler)
+
+  return (total, imports)
+
+
+###################################################################
+#
+# measure:
+#
+# Imports the handler runs + 1 times, and returns the median import
+# time in ms (the first run, which compiles .pyc files, is
+# discarded) and the direct imports of the median run.
+#
+def measure(handler, runs):
+  import_times(handler)  # warm up: compile .pyc files
+
+  results = sorted(import_times(handler) for _ in range(runs))
+  (total, imports) = results[len(results) // 2]
+
+  return (total / 1000.0, imports)
+
+
+###################################################################
+#
+# main
+#
+if __name__ == "__main__":
+  args = sys.argv[1:]
+
+  runs = DEFAULT_RUNS
+  if len(args) > 1 and args[0] == "--runs":
+    runs = int(args[1])
+    args = args[2:]
+
+  config_file = args[0] if len(args) > 0 else "musicapp-config.ini"
+
+  #
+  # the config file is optional here, without one every handler
+  # gets the default budget:
+  #
+  configur = ConfigParser()
+  configur.read(config_file)
+
+  default_budget = configur.getfloat('import_budget', 'default', fallback=DEFAULT_BUDGET_MS)
+
+  failed = False
+
+  for path in sorted(HANDLERS_DIR.glob("final-project-*.py")):
+    handler = path.name
+    budget = configur.getfloat('import_budget', handler, fallback=default_budget)
+
+    try:
+      (ms, imports) = measure(handler, runs)
+
+    except Exception as err:
+      print("**ERROR**", str(err))
+      failed = True
+      continue
+
+    if ms > budget:
+      failed = True
+      print("OVER %-32s %7.1f ms  (budget %.0f ms)" % (handler, ms, budget))
+    else:
+      print("ok   %-32s %7.1f ms  (budget %.0f ms)" % (handler, ms, budget))
+
+    for (cumulative, name) in sorted(imports, reverse=True)[:TOP_IMPORTS]:
+      print("       %-30s %7.1f ms" % (name, cumulative / 1000.0))
+
+  sys.exit(1 if failed else 0)
@@ -0,0 +1,79 @@
+#
+# lrucache.py
+#
+# A thread-safe in-process cache with per-entry TTLs and least
+# recently used eviction, shared by datatier's query cache and
+# emotion's score cache. No dependencies, so importing it costs
+# nothing.
+#
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+MISSING = object()  # get()'s result when there is no live entry
+
+
+class LRUCache:
+
+  def __init__(self, max_entries):
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+
+    self._entries = OrderedDict()  # key -> (expiration time, value)
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    with self._lock:
+      return len(self._entries)
+
+  def get(self, key):
+    """
+    Returns the cached value for key, or MISSING if there is no
+    live entry
+    """
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None:
+        (expires, value) = entry
+        if time.monotonic() < expires:
+          self._entries.move_to_end(key)  # most recently used
+          self.hits += 1
+          return value
+        del self._entries[key]  # expired
+
+      self.misses += 1
+      return MISSING
+
+  def put(self, key, value, ttl):
+    """
+    Caches value under key for ttl seconds (not at all if ttl is
+    None or <= 0)
+    """
+    if ttl is None or ttl <= 0:
+      return
+
+    with self._lock:
+      self._entries[key] = (time.monotonic() + ttl, value)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)  # least recently used
+
+  def invalidate(self, match=None):
+    """
+    Drops cached entries: all of them if match is None, else those
+    whose key match(key) is true for; returns # dropped
+    """
+    with self._lock:
+      if match is None:
+        n = len(self._entries)
+        self._entries.clear()
+        return n
+
+      doomed = [key for key in self._entries if match(key)]
+      for key in doomed:
+        del self._entries[key]
+      return len(doomed)
@@ -3,6 +3,7 @@ Client Side Music Recommendation App
 '''
 import requests
 import json
+import hashlib
 import random
 
 import uuid
@@ -10,7 +11,6 @@ import pathlib
 import logging
 import sys
 import os
-import base64
 import time
 from configparser import ConfigParser
 
@@ -142,7 +142,9 @@ def prompt():
 def upload(baseurl, file_type):
   """
   Prompts the user for a local filename and user id, 
-  and uploads that asset to S3 for processing. 
+  and uploads that asset to S3 for processing: the web
+  service creates the job and returns a presigned URL,
+  and the file is then PUT straight to S3.
 
   Parameters
   ----------
@@ -165,29 +167,18 @@ def upload(baseurl, file_type):
     userid = input()
 
     #
-    # build the data packet. First step is read the file
-    # as raw bytes:
+    # step 1: ask the web service for a job and an upload URL,
+    # sending the file's SHA-256 (S3 checks the upload against
+    # it, and the analysis reuses it):
     #
-    infile = open(local_filename, "rb")
-    bytes = infile.read()
-    infile.close()
+    digest = hashlib.sha256()
+    with open(local_filename, "rb") as infile:
+      for chunk in iter(lambda: infile.read(1024 * 1024), b""):
+        digest.update(chunk)
 
-    #
-    # now encode the file as base64. Note b64encode returns
-    # a bytes object, not a string. So then we have to convert
-    # (decode) the bytes -> string, and then we can serialize
-    # the string as JSON for upload to server:
-    #
-    data = base64.b64encode(bytes)
-    datastr = data.decode("utf-8")
-
-    data = {"filename": local_filename, "data": datastr}
-
-    #
-    # call the web service:
-    #
+    data = {"filename": local_filename, "sha256": digest.hexdigest()}
 
-    url = baseurl + f"/{file_type}/" + userid
+    url = baseurl + "/upload-url/" + userid
     
     res = requests.post(url, json=data)
     #
@@ -195,7 +186,7 @@ def upload(baseurl, file_type):
     #
     if res.status_code == 200: #success
       pass
-    elif res.status_code == 400: # no such user
+    elif res.status_code == 400: # no such user, or bad file type
       body = res.json()
       print(body)
       return
@@ -211,11 +202,25 @@ def upload(baseurl, file_type):
       return
 
     #
-    # success, extract jobid:
+    # success, extract jobid and upload URL:
     #
     body = res.json()
 
-    jobid = body
+    jobid = body["jobid"]
+
+    #
+    # step 2: PUT the raw file to S3, streamed from disk, with
+    # the headers the URL was signed for:
+    #
+    url = body["url"]
+
+    with open(local_filename, "rb") as infile:
+      res = requests.put(url, data=infile, headers=body["headers"])
+
+    if res.status_code != 200:
+      print("Upload to S3 failed with status code:", res.status_code)
+      print(res.text)
+      return
 
     print("file uploaded, job id =", jobid)
     return
@@ -0,0 +1,331 @@
+#
+# migrate.py
+#
+# Applies the versioned schema migrations in migrations/ to the
+# MusicApp database (every shard), and checks that the SQL the
+# handlers issue is served by indexes.
+#
+# A migration is a file migrations/NNNN_description.sql, applied
+# in order of its version NNNN. If a file
+# migrations/NNNN_description.sqlite.sql exists, it is applied
+# instead on SQLite databases. Applied versions are recorded in
+# the schema_migrations table, so each migration runs once.
+#
+# Usage:
+#   python migrate.py [config_file]          apply pending migrations
+#   python migrate.py --status [config_file] list applied/pending
+#   python migrate.py --check [config_file]  EXPLAIN handler SQL,
+#                                            fail on full scans
+#
+# The config file defaults to musicapp-config.ini.
+#
+
+import datatier
+import pathlib
+import re
+import sys
+
+from configparser import ConfigParser
+
+
+MIGRATIONS_DIR = pathlib.Path(__file__).parent / "migrations"
+
+_RE_MIGRATION = re.compile(r"^(\d+)_(.+?)(\.sqlite)?\.sql$")
+
+
+###################################################################
+#
+# HANDLER_QUERIES:
+#
+# Every SELECT / UPDATE / DELETE the handlers run, with sample
+# parameters; --check runs EXPLAIN on each. Keep in sync with the
+# SQL in the final-project-*.py handlers.
+#
+HANDLER_QUERIES = [
+  ("final-project-upload.py",
+   "SELECT * FROM users WHERE userid = %s;", [80001]),
+  ("final-project-upload.py",
+   "Update jobs Set status = %s, completed_at = NOW() Where jobid = %s", ["error", 1001]),
+  ("final-project-playlist.py",
+   "SELECT * FROM users WHERE userid = %s", [80001]),
+  ("final-project-playlist.py",
+   "SELECT MIN(seq), MAX(seq) FROM user_tracks WHERE userid = %s", [80001]),
+  ("final-project-playlist.py",
+   "SELECT ut.trackid, ut.userid, ut.jobid, t.trackname, t.trackartist FROM user_tracks ut JOIN tracks t ON t.trackid = ut.trackid WHERE ut.userid = %s", [80001]),
+  ("final-project-playlist.py",
+   "SELECT ut.trackid, ut.userid, ut.jobid, t.trackname, t.trackartist FROM user_tracks ut JOIN tracks t ON t.trackid = ut.trackid WHERE ut.userid = %s AND ut.seq IN (%s, %s)", [80001, 1, 2]),
+  ("final-project-get-analysis.py, final-project-songrec.py",
+   "SELECT jobid, userid, status, originaldatafile, datafilekey, valence, energy FROM jobs WHERE jobid = %s;", [1001]),
+  ("final-project-get-analysis.py, final-project-songrec.py",
+   "SELECT jobid, userid, status, originaldatafile, datafilekey, valence, energy FROM jobs_archive WHERE jobid = %s;", [1001]),
+  ("final-project-songrec.py",
+   "SELECT trackid, trackname, trackartist FROM tracks WHERE trackname IN (%s, %s) FOR SHARE", ["a", "b"]),
+  ("final-project-songrec.py",
+   "SELECT COALESCE(MAX(seq), 0) FROM user_tracks WHERE userid = %s FOR UPDATE", [80001]),
+  ("final-project-songrec.py",
+   "SELECT trackid FROM user_tracks WHERE jobid = %s FOR SHARE", [1001]),
+  ("final-project-text-analysis.py, final-project-image-analysis.py",
+   "Update jobs Set status = %s, valence = %s, energy = %s, completed_at = NOW() Where datafilekey = %s",
+   ["completed", "0.5", "0.5", "musicapp/x.txt"]),
+  ("final-project-text-analysis.py, final-project-image-analysis.py",
+   "Update jobs Set status = %s, content_hash = %s Where datafilekey = %s", ["processing - starting", "0" * 64, "musicapp/x.txt"]),
+  ("final-project-text-analysis.py, final-project-image-analysis.py",
+   "SELECT valence, energy FROM jobs WHERE content_hash = %s AND status = 'completed' AND datafilekey <> %s LIMIT 1",
+   ["0" * 64, "musicapp/x.txt"]),
+  ("final-project-text-analysis.py, final-project-image-analysis.py",
+   "SELECT valence, energy FROM jobs_archive WHERE content_hash = %s AND status = 'completed' AND datafilekey <> %s LIMIT 1",
+   ["0" * 64, "musicapp/x.txt"]),
+  ("final-project-archive.py",
+   "SELECT jobid FROM jobs WHERE status IN ('completed', 'error') AND completed_at < %s LIMIT %s;",
+   ["2000-01-01 00:00:00", 500]),
+  ("final-project-archive.py",
+   "DELETE FROM jobs WHERE jobid IN (%s, %s)", [1001, 1002]),
+]
+
+
+###################################################################
+#
+# get_migrations:
+#
+# Returns the available migrations, in order, as a list of
+# (version, description, file) for the given dialect.
+#
+def get_migrations(sqlite):
+  """
+  Returns the migrations in MIGRATIONS_DIR
+
+  Parameters
+  ----------
+  sqlite : True to prefer the .sqlite.sql variants
+
+  Returns
+  -------
+  list of (version, description, path) sorted by version
+  """
+  migrations = {}
+
+  for path in sorted(MIGRATIONS_DIR.glob("*.sql")):
+    m = _RE_MIGRATION.match(path.name)
+    if m is None:
+      print("**WARNING: ignoring", path.name, "(expecting NNNN_description.sql)")
+      continue
+
+    version = int(m.group(1))
+    is_sqlite_variant = m.group(3) is not None
+
+    if is_sqlite_variant and not sqlite:
+      continue
+    if version in migrations and not is_sqlite_variant:
+      continue  # already have the .sqlite.sql variant
+
+    migrations[version] = (version, m.group(2), path)
+
+  return [migrations[v] for v in sorted(migrations)]
+
+
+###################################################################
+#
+# split_statements:
+#
+# Splits an SQL script into statements: strips -- comments and
+# splits at semicolons that end a line.
+#
+def split_statements(script):
+  lines = []
+  for line in script.splitlines():
+    #
+    # drop the comment, if any, unless the -- is inside a quoted
+    # string (i.e. preceded by an odd number of quotes):
+    #
+    pos = line.find("--")
+    while pos >= 0 and line.count("'", 0, pos) % 2 == 1:
+      pos = line.find("--", pos + 2)
+    if pos >= 0:
+      line = line[:pos]
+    lines.append(line)
+
+  statements = re.split(r";\s*$", "\n".join(lines), flags=re.MULTILINE)
+  return [stmt.strip() for stmt in statements if stmt.strip() != ""]
+
+
+###################################################################
+#
+# applied_versions:
+#
+# Creates the schema_migrations table if need be, and returns the
+# set of versions already applied.
+#
+def applied_versions(dbConn):
+  sql = """
+    CREATE TABLE IF NOT EXISTS schema_migrations
+    (
+      version      int not null,
+      description  varchar(256) not null,
+      applied_at   timestamp not null default CURRENT_TIMESTAMP,
+      PRIMARY KEY  (version)
+    )
+  """
+  datatier.perform_action(dbConn, sql)
+
+  rows = datatier.retrieve_all_rows(dbConn, "SELECT version FROM schema_migrations")
+  return set(row[0] for row in rows)
+
+
+###################################################################
+#
+# migrate:
+#
+# Applies the pending migrations to one database.
+#
+def migrate(dbConn, sqlite):
+  """
+  Applies pending migrations, in order, stopping at the first
+  failure
+
+  Parameters
+  ----------
+  dbConn : the database connection,
+  sqlite : True if the database is SQLite
+
+  Returns
+  -------
+  number of migrations applied
+  """
+  applied = applied_versions(dbConn)
+  count = 0
+
+  for (version, description, path) in get_migrations(sqlite):
+    if version in applied:
+      continue
+
+    print("  applying", path.name)
+
+    with open(path, "r") as f:
+      statements = split_statements(f.read())
+
+    #
+    # NOTE: MySQL commits DDL implicitly, so a failed migration
+    # can be partially applied there; SQLite rolls back the
+    # whole migration:
+    #
+    with datatier.transaction(dbConn):
+      for sql in statements:
+        datatier.perform_action(dbConn, sql)
+
+      sql = "INSERT INTO schema_migrations(version, description) VALUES(%s, %s)"
+      datatier.perform_action(dbConn, sql, [version, description])
+
+    count += 1
+
+  return count
+
+
+###################################################################
+#
+# full_table_scans:
+#
+# Runs EXPLAIN on sql and returns a list of the tables it reads
+# with a full scan, of the table or of a whole index (an index
+# scan still reads every row, just in index order).
+#
+def full_table_scans(dbConn, sql, parameters, sqlite):
+  if sqlite:
+    #
+    # EXPLAIN QUERY PLAN rows are (id, parent, notused, detail);
+    # an indexed lookup is "SEARCH <table> ...", a full scan is
+    # "SCAN <table> [USING [COVERING] INDEX ...]":
+    #
+    rows = datatier.retrieve_all_rows(dbConn, "EXPLAIN QUERY PLAN " + sql, parameters)
+    scans = []
+    for row in rows:
+      detail = row[3]
+      if detail.startswith("SCAN "):
+        scans.append(detail.replace("SCAN TABLE ", "SCAN ").split()[1])
+    return scans
+
+  #
+  # MySQL EXPLAIN rows are (id, select_type, table, partitions,
+  # type, possible_keys, key, ...); type ALL is a full table
+  # scan and type index a full index scan:
+  #
+  rows = datatier.retrieve_all_rows(dbConn, "EXPLAIN " + sql, parameters)
+  return [row[2] for row in rows if row[4] in ["ALL", "index"]]
+
+
+###################################################################
+#
+# check:
+#
+# EXPLAINs every handler query, and returns the # that do a full
+# scan.
+#
+def check(dbConn, sqlite):
+  failures = 0
+
+  for (handler, sql, parameters) in HANDLER_QUERIES:
+    scans = full_table_scans(dbConn, sql, parameters, sqlite)
+    if len(scans) > 0:
+      failures += 1
+      print("  FULL SCAN of", ", ".join(scans), "in", handler + ":", sql)
+    else:
+      print("  ok:", handler + ":", sql)
+
+  return failures
+
+
+###################################################################
+#
+# main
+#
+if __name__ == "__main__":
+  args = sys.argv[1:]
+
+  mode = "migrate"
+  if len(args) > 0 and args[0] in ["--status", "--check"]:
+    mode = args[0][2:]
+    args = args[1:]
+
+  config_file = args[0] if len(args) > 0 else "musicapp-config.ini"
+
+  if not pathlib.Path(config_file).is_file():
+    print("**ERROR: config file '", config_file, "' does not exist, exiting")
+    sys.exit(1)
+
+  configur = ConfigParser()
+  configur.read(config_file)
+
+  shards = datatier.ShardMap.from_config(configur)
+  failed = False
+
+  for shard in range(len(shards)):
+    sqlite = shards.shards[shard]["endpoint"].startswith(datatier.SQLITE_PREFIX)
+    print("**Shard", shard, "(" + shards.shards[shard]["endpoint"] + ")**")
+
+    #
+    # migrate (and EXPLAIN against) the writer of each shard:
+    #
+    routed = shards.get_dbConn(shard)
+    dbConn = routed.writer()
+
+    try:
+      if mode == "migrate":
+        print("  applied", migrate(dbConn, sqlite), "migration(s)")
+
+      elif mode == "status":
+        applied = applied_versions(dbConn)
+        for (version, description, path) in get_migrations(sqlite):
+          print("  " + ("applied " if version in applied else "pending ") + path.name)
+
+      else:
+        if check(dbConn, sqlite) > 0:
+          failed = True
+
+    except Exception as err:
+      print("**ERROR**")
+      print(str(err))
+      failed = True
+
+    finally:
+      routed.close()
+
+  sys.exit(1 if failed else 0)
@@ -0,0 +1,16 @@
+--
+-- Indexes for the queries the handlers issue on every request
+-- (PRIMARY KEYs and UNIQUE(datafilekey) already cover lookups by
+-- userid, jobid and datafilekey):
+--
+-- playlist: SELECT * FROM songs WHERE userid = %s ORDER BY songname
+--   => covering index, rows come back in songname order without
+--      a filesort or a lookup of the row itself
+--
+CREATE INDEX songs_userid_songname ON songs(userid, songname, jobid, songartist);
+
+--
+-- a user's jobs by status, e.g. "which of my jobs are still
+-- processing?"; also serves the jobs.userid foreign key
+--
+CREATE INDEX jobs_userid_status ON jobs(userid, status);
@@ -0,0 +1,48 @@
+--
+-- Job timestamps and cold archive tables (see
+-- final-project-archive.py): completed and errored jobs older
+-- than the archive cutoff, and their songs, are moved out of the
+-- hot jobs/songs tables into jobs_archive/songs_archive, so the
+-- hot tables and their indexes stay small. (InnoDB cannot
+-- partition tables with foreign keys, so the hot/cold split is
+-- done with separate tables.)
+--
+ALTER TABLE jobs ADD COLUMN created_at datetime not null default CURRENT_TIMESTAMP;
+ALTER TABLE jobs ADD COLUMN completed_at datetime null;  -- when completed / errored
+
+UPDATE jobs SET completed_at = created_at WHERE status IN ('completed', 'error');
+
+--
+-- archival job: finished jobs ordered by age
+--
+CREATE INDEX jobs_status_completed_at ON jobs(status, completed_at);
+
+--
+-- cold tables are rarely read, so store them compressed:
+--
+CREATE TABLE jobs_archive
+(
+    jobid             int not null,
+    userid            int not null,
+    status            varchar(256) not null,
+    originaldatafile  varchar(256) not null,
+    datafilekey       varchar(256) not null,
+    valence           float not null default 0.0,
+    energy            float not null default 0.0,
+    created_at        datetime null,
+    completed_at      datetime null,
+    archived_at       datetime not null default CURRENT_TIMESTAMP,
+    PRIMARY KEY (jobid)
+) ROW_FORMAT=COMPRESSED;
+
+CREATE TABLE songs_archive
+(
+    songid       int not null,
+    userid       int not null,
+    jobid        int not null,
+    songname     varchar(256) not null,
+    songartist   varchar(256) not null,
+    PRIMARY KEY  (songid)
+) ROW_FORMAT=COMPRESSED;
+
+CREATE INDEX songs_archive_jobid ON songs_archive(jobid);
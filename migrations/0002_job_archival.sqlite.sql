@@ -0,0 +1,45 @@
+--
+-- SQLite version of 0002_job_archival.sql. SQLite cannot ADD
+-- COLUMN with a non-constant default, so created_at is filled in
+-- by a trigger instead; and it does not index foreign keys, so
+-- songs(jobid), used when archiving a job's songs, is indexed
+-- explicitly.
+--
+ALTER TABLE jobs ADD COLUMN created_at datetime null;
+ALTER TABLE jobs ADD COLUMN completed_at datetime null;  -- when completed / errored
+
+UPDATE jobs SET created_at = CURRENT_TIMESTAMP;
+UPDATE jobs SET completed_at = created_at WHERE status IN ('completed', 'error');
+
+CREATE TRIGGER jobs_created_at AFTER INSERT ON jobs FOR EACH ROW WHEN NEW.created_at IS NULL
+  BEGIN UPDATE jobs SET created_at = CURRENT_TIMESTAMP WHERE jobid = NEW.jobid; END;
+
+CREATE INDEX jobs_status_completed_at ON jobs(status, completed_at);
+CREATE INDEX songs_jobid ON songs(jobid);
+
+CREATE TABLE jobs_archive
+(
+    jobid             int not null,
+    userid            int not null,
+    status            varchar(256) not null,
+    originaldatafile  varchar(256) not null,
+    datafilekey       varchar(256) not null,
+    valence           float not null default 0.0,
+    energy            float not null default 0.0,
+    created_at        datetime null,
+    completed_at      datetime null,
+    archived_at       datetime not null default CURRENT_TIMESTAMP,
+    PRIMARY KEY (jobid)
+);
+
+CREATE TABLE songs_archive
+(
+    songid       int not null,
+    userid       int not null,
+    jobid        int not null,
+    songname     varchar(256) not null,
+    songartist   varchar(256) not null,
+    PRIMARY KEY  (songid)
+);
+
+CREATE INDEX songs_archive_jobid ON songs_archive(jobid);
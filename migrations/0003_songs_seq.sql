@@ -0,0 +1,21 @@
+--
+-- Playlist sampling (final-project-playlist.py): number each
+-- user's songs 1, 2, 3, ... (seq), so a random sample of a
+-- user's songs is a set of random seq values, looked up on the
+-- (userid, seq) index, instead of reading and shuffling all of
+-- the user's songs. songrec numbers new songs as it inserts them;
+-- archiving songs leaves gaps, which the playlist skips over.
+--
+ALTER TABLE songs ADD COLUMN seq int not null default 0;
+
+UPDATE songs s
+  JOIN (SELECT songid, ROW_NUMBER() OVER (PARTITION BY userid ORDER BY songid) AS rn FROM songs) r
+    ON s.songid = r.songid
+   SET s.seq = r.rn;
+
+CREATE UNIQUE INDEX songs_userid_seq ON songs(userid, seq);
+
+--
+-- the playlist no longer reads songs in songname order:
+--
+DROP INDEX songs_userid_songname ON songs;
@@ -0,0 +1,14 @@
+--
+-- SQLite version of 0003_songs_seq.sql (UPDATE ... FROM instead
+-- of UPDATE ... JOIN, and DROP INDEX takes no table name).
+--
+ALTER TABLE songs ADD COLUMN seq int not null default 0;
+
+UPDATE songs
+   SET seq = r.rn
+  FROM (SELECT songid, ROW_NUMBER() OVER (PARTITION BY userid ORDER BY songid) AS rn FROM songs) AS r
+ WHERE songs.songid = r.songid;
+
+CREATE UNIQUE INDEX songs_userid_seq ON songs(userid, seq);
+
+DROP INDEX songs_userid_songname;
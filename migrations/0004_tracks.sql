@@ -0,0 +1,67 @@
+--
+-- Normalized songs: a catalog of tracks, one row per distinct
+-- (name, artist) with a stable trackid, and a narrow user_tracks
+-- table recording which tracks were recommended to which user for
+-- which job. Replaces songs / songs_archive, whose global
+-- UNIQUE(songname) failed songrec whenever a track had already
+-- been recommended (to anyone). songrec adds tracks with a bulk
+-- INSERT IGNORE, so a known track is simply reused.
+--
+-- Names are compared exactly (utf8mb4_bin), so tracks that differ
+-- only in case or accents stay distinct.
+--
+CREATE TABLE tracks
+(
+    trackid      int not null AUTO_INCREMENT,
+    trackname    varchar(256) COLLATE utf8mb4_bin not null,
+    trackartist  varchar(256) COLLATE utf8mb4_bin not null,
+    PRIMARY KEY  (trackid),
+    UNIQUE       (trackname, trackartist)
+);
+
+--
+-- clustered by (userid, seq), so the playlist's seq lookups (see
+-- 0003_songs_seq.sql) read one primary key entry per track;
+-- UNIQUE(jobid, trackid) serves the archival job's jobid lookups
+-- and keeps a repeated songrec from adding a job's track twice:
+--
+CREATE TABLE user_tracks
+(
+    userid       int not null,
+    seq          int not null,
+    jobid        int not null,
+    trackid      int not null,
+    PRIMARY KEY  (userid, seq),
+    UNIQUE       (jobid, trackid),
+    FOREIGN KEY  (userid) REFERENCES users(userid),
+    FOREIGN KEY  (jobid) REFERENCES jobs(jobid),
+    FOREIGN KEY  (trackid) REFERENCES tracks(trackid)
+);
+
+CREATE TABLE user_tracks_archive
+(
+    userid       int not null,
+    jobid        int not null,
+    trackid      int not null,
+    PRIMARY KEY  (jobid, trackid)
+) ROW_FORMAT=COMPRESSED;
+
+--
+-- copy the existing songs over:
+--
+INSERT IGNORE INTO tracks(trackname, trackartist)
+  SELECT songname, songartist FROM songs ORDER BY songid;
+
+INSERT IGNORE INTO tracks(trackname, trackartist)
+  SELECT songname, songartist FROM songs_archive ORDER BY songid;
+
+INSERT IGNORE INTO user_tracks(userid, seq, jobid, trackid)
+  SELECT s.userid, s.seq, s.jobid, t.trackid
+    FROM songs s JOIN tracks t ON t.trackname = s.songname AND t.trackartist = s.songartist;
+
+INSERT IGNORE INTO user_tracks_archive(userid, jobid, trackid)
+  SELECT s.userid, s.jobid, t.trackid
+    FROM songs_archive s JOIN tracks t ON t.trackname = s.songname AND t.trackartist = s.songartist;
+
+DROP TABLE songs_archive;
+DROP TABLE songs;
@@ -0,0 +1,50 @@
+--
+-- SQLite version of 0004_tracks.sql (SQLite compares text
+-- exactly by default, and a WITHOUT ROWID table is clustered by
+-- its primary key, like InnoDB).
+--
+CREATE TABLE tracks
+(
+    trackid      integer not null PRIMARY KEY AUTOINCREMENT,
+    trackname    varchar(256) not null,
+    trackartist  varchar(256) not null,
+    UNIQUE       (trackname, trackartist)
+);
+
+CREATE TABLE user_tracks
+(
+    userid       int not null,
+    seq          int not null,
+    jobid        int not null,
+    trackid      int not null,
+    PRIMARY KEY  (userid, seq),
+    UNIQUE       (jobid, trackid),
+    FOREIGN KEY  (userid) REFERENCES users(userid),
+    FOREIGN KEY  (jobid) REFERENCES jobs(jobid),
+    FOREIGN KEY  (trackid) REFERENCES tracks(trackid)
+) WITHOUT ROWID;
+
+CREATE TABLE user_tracks_archive
+(
+    userid       int not null,
+    jobid        int not null,
+    trackid      int not null,
+    PRIMARY KEY  (jobid, trackid)
+) WITHOUT ROWID;
+
+INSERT OR IGNORE INTO tracks(trackname, trackartist)
+  SELECT songname, songartist FROM songs ORDER BY songid;
+
+INSERT OR IGNORE INTO tracks(trackname, trackartist)
+  SELECT songname, songartist FROM songs_archive ORDER BY songid;
+
+INSERT OR IGNORE INTO user_tracks(userid, seq, jobid, trackid)
+  SELECT s.userid, s.seq, s.jobid, t.trackid
+    FROM songs s JOIN tracks t ON t.trackname = s.songname AND t.trackartist = s.songartist;
+
+INSERT OR IGNORE INTO user_tracks_archive(userid, jobid, trackid)
+  SELECT s.userid, s.jobid, t.trackid
+    FROM songs_archive s JOIN tracks t ON t.trackname = s.songname AND t.trackartist = s.songartist;
+
+DROP TABLE songs_archive;
+DROP TABLE songs;
@@ -0,0 +1,12 @@
+--
+-- Content-addressed analysis results: the analysis handlers store
+-- the SHA-256 of each uploaded file on its job, and a file that
+-- has been analyzed before (a completed job with the same hash)
+-- gets that job's valence and energy instead of another
+-- HuggingFace / Rekognition call.
+--
+ALTER TABLE jobs ADD COLUMN content_hash char(64) null;  -- hex SHA-256 of the file
+ALTER TABLE jobs_archive ADD COLUMN content_hash char(64) null;
+
+CREATE INDEX jobs_content_hash ON jobs(content_hash, status);
+CREATE INDEX jobs_archive_content_hash ON jobs_archive(content_hash, status);
@@ -0,0 +1,24 @@
+--
+-- Archiving a job no longer moves its songs: the playlist samples
+-- user_tracks only, so archived songs dropped out of every
+-- playlist. user_tracks rows are small, so they stay in the hot
+-- table, which means a song may now belong to an archived job and
+-- user_tracks(jobid) can no longer reference jobs(jobid).
+--
+-- (user_tracks_ibfk_2 is the name MySQL gave the unnamed jobid
+-- foreign key of 0004_tracks.sql, its 2nd.)
+--
+ALTER TABLE user_tracks DROP FOREIGN KEY user_tracks_ibfk_2;
+
+--
+-- move the songs archived so far back, numbered after each user's
+-- last song (IGNORE: a track the job already has again is skipped):
+--
+INSERT IGNORE INTO user_tracks(userid, seq, jobid, trackid)
+  SELECT a.userid,
+         COALESCE(m.lastseq, 0) + ROW_NUMBER() OVER (PARTITION BY a.userid ORDER BY a.jobid, a.trackid),
+         a.jobid, a.trackid
+    FROM user_tracks_archive a
+    LEFT JOIN (SELECT userid, MAX(seq) AS lastseq FROM user_tracks GROUP BY userid) m ON m.userid = a.userid;
+
+DROP TABLE user_tracks_archive;
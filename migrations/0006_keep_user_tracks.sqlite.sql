@@ -0,0 +1,30 @@
+--
+-- SQLite version of 0006_keep_user_tracks.sql. SQLite cannot drop
+-- a foreign key, so user_tracks is rebuilt without it.
+--
+CREATE TABLE user_tracks_new
+(
+    userid       int not null,
+    seq          int not null,
+    jobid        int not null,
+    trackid      int not null,
+    PRIMARY KEY  (userid, seq),
+    UNIQUE       (jobid, trackid),
+    FOREIGN KEY  (userid) REFERENCES users(userid),
+    FOREIGN KEY  (trackid) REFERENCES tracks(trackid)
+) WITHOUT ROWID;
+
+INSERT INTO user_tracks_new(userid, seq, jobid, trackid)
+  SELECT userid, seq, jobid, trackid FROM user_tracks;
+
+INSERT OR IGNORE INTO user_tracks_new(userid, seq, jobid, trackid)
+  SELECT a.userid,
+         COALESCE(m.lastseq, 0) + ROW_NUMBER() OVER (PARTITION BY a.userid ORDER BY a.jobid, a.trackid),
+         a.jobid, a.trackid
+    FROM user_tracks_archive a
+    LEFT JOIN (SELECT userid, MAX(seq) AS lastseq FROM user_tracks GROUP BY userid) m ON m.userid = a.userid;
+
+DROP TABLE user_tracks;
+ALTER TABLE user_tracks_new RENAME TO user_tracks;
+
+DROP TABLE user_tracks_archive;
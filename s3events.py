@@ -0,0 +1,261 @@
+#
+# s3events.py
+#
+# Batches of S3 upload notifications for the analysis handlers
+# (final-project-text-analysis.py, final-project-image-analysis.py).
+# An invocation may carry several records: S3 event notifications,
+# or SQS messages whose bodies are S3 event notifications. Each
+# uploaded object is analyzed on its own worker thread, at most
+# RECORD_CONCURRENCY at a time, so a batch takes about as long as
+# its slowest upload:
+#
+#   return s3events.process_records(event, analyze)
+#
+# where analyze(bucketkey) analyzes one upload, and returns None on
+# success or an error message; a failed upload does not affect the
+# others. job_dbConn() lends analyze a database connection for the
+# job's queries, content_sha256() and prior_result() let it reuse
+# the result of a file analyzed before.
+#
+
+import base64
+import datatier
+import hashlib
+import json
+import urllib.parse
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+#
+# uploads analyzed at once; an upload holds a database connection
+# only for its queries (see job_dbConn), not while it is analyzed,
+# so this may be larger than datatier.POOL_MAX_SIZE:
+#
+RECORD_CONCURRENCY = 4
+
+HASH_CHUNK = 1024 * 1024  # bytes of an object read at a time, see s3_sha256
+
+UPLOAD_PREFIX = "musicapp/"  # bucket keys of uploads; other objects are skipped
+
+
+###################################################################
+#
+# s3_records:
+#
+# Returns the bucket key of each S3 object in the event, with the
+# id of the SQS message that delivered it (None for a direct S3
+# notification), and an error message for a record that could not
+# be read (e.g. a malformed SQS message), so that it fails on its
+# own. Objects that are not uploads, e.g. emotion.py's cache
+# entries should the trigger not filter them out, are skipped.
+#
+def s3_records(event):
+  """
+  Extracts the uploaded objects from a Lambda event
+
+  Parameters
+  __________
+  event : an S3 event notification, or an SQS event whose messages
+          are S3 event notifications
+
+  Returns
+  _______
+  list of (bucketkey, message_id, error), in event order; error is
+  None, or the record's error message (bucketkey is then None)
+  """
+  records = []
+
+  for record in event.get('Records', []):
+    message_id = record.get('messageId')
+
+    try:
+      if 's3' in record:
+        _append_upload(records, _bucketkey(record), None)
+
+      elif 'body' in record:
+        #
+        # an SQS message; S3's test event (sent when the
+        # notification is configured) has no Records, and is
+        # skipped:
+        #
+        body = json.loads(record['body'])
+        for s3_record in body.get('Records', []):
+          _append_upload(records, _bucketkey(s3_record), message_id)
+
+      else:
+        raise Exception("expecting an S3 or SQS event record")
+
+    except Exception as err:
+      print("**ERROR** reading event record", message_id)
+      print(str(err))
+      records.append((None, message_id, "bad event record: " + str(err)))
+
+  return records
+
+
+def _bucketkey(record):
+  return urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')
+
+
+def _append_upload(records, bucketkey, message_id):
+  if not bucketkey.startswith(UPLOAD_PREFIX):
+    print("**Skipping", bucketkey, "(not an upload)**")
+    return
+  records.append((bucketkey, message_id, None))
+
+
+###################################################################
+#
+# process_records:
+#
+# Runs analyze(bucketkey) for every object in the event, on a pool
+# of worker threads, and returns the Lambda response.
+#
+def process_records(event, analyze, concurrency=RECORD_CONCURRENCY):
+  """
+  Analyzes every uploaded object in the event concurrently
+
+  Parameters
+  __________
+  event : the Lambda event (see s3_records),
+  analyze : function(bucketkey) returning None on success, or an
+            error message,
+  concurrency : max # of objects analyzed at once
+
+  Returns
+  _______
+  response dict: statusCode 200 if every object was analyzed, else
+  500; the body lists each bucket key with "success" or its error.
+  For SQS events, batchItemFailures lists the messages to redeliver.
+  """
+  records = s3_records(event)
+
+  print("**Analyzing", len(records), "upload(s)**")
+
+  errors = [error for (bucketkey, message_id, error) in records]
+  todo = [i for (i, error) in enumerate(errors) if error is None]
+
+  if len(todo) > 0:
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(todo))) as executor:
+      futures = {i: executor.submit(analyze, records[i][0]) for i in todo}
+
+      #
+      # analyze reports its errors, but should it raise instead,
+      # that fails only its own record:
+      #
+      for (i, future) in futures.items():
+        try:
+          errors[i] = future.result()
+        except Exception as err:
+          print("**ERROR**", records[i][0])
+          print(str(err))
+          errors[i] = str(err)
+
+  results = []
+  failed_messages = []
+
+  for ((bucketkey, message_id, _), error) in zip(records, errors):
+    results.append({'bucketkey': bucketkey, 'result': "success" if error is None else error})
+
+    if error is not None and message_id is not None and message_id not in failed_messages:
+      failed_messages.append(message_id)
+
+  ok = all(error is None for error in errors)
+
+  return {
+    'statusCode': 200 if ok else 500,
+    'body': json.dumps(results),
+    'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_messages]
+  }
+
+
+###################################################################
+#
+# job_dbConn:
+#
+# A connection to the shard of an upload's job, for a few queries:
+#
+#   with s3events.job_dbConn(shards, bucketkey) as dbConn:
+#     datatier.perform_action(dbConn, sql, [...])
+#
+# returns it to the pool on exit, so the uploads analyzed at once
+# take turns on the pool's connections instead of each holding one
+# through the (slow) HuggingFace or Rekognition calls.
+#
+@contextmanager
+def job_dbConn(shards, bucketkey):
+  dbConn = shards.get_dbConn(shards.shard_for_bucketkey(bucketkey))  # the bucket key records the shard
+  try:
+    yield dbConn
+  finally:
+    dbConn.close()
+
+
+###################################################################
+#
+# content_sha256:
+#
+# Returns the SHA-256 of an uploaded file. The uploads ask S3 for
+# a SHA-256 checksum (final-project-upload.py) or have one signed
+# into the presigned PUT (final-project-upload-url.py), so it is
+# read from the object's metadata; objects without a full-object
+# checksum (uploaded before, or multipart, whose checksum is a
+# checksum of the parts' checksums) are read and hashed.
+#
+def content_sha256(s3, bucketname, bucketkey):
+  """
+  Returns the SHA-256 of an S3 object
+
+  Parameters
+  __________
+  s3 : S3 client,
+  bucketname : the bucket,
+  bucketkey : the object's key
+
+  Returns
+  _______
+  the hex SHA-256 of the object's content
+  """
+  response = s3.head_object(Bucket=bucketname, Key=bucketkey, ChecksumMode='ENABLED')
+
+  checksum = response.get('ChecksumSHA256')
+  full_object = response.get('ChecksumType', 'FULL_OBJECT') == 'FULL_OBJECT'
+
+  if checksum is not None and full_object and '-' not in checksum:
+    return base64.b64decode(checksum).hex()
+
+  return s3_sha256(s3, bucketname, bucketkey)
+
+
+def s3_sha256(s3, bucketname, bucketkey):
+  """
+  Returns the hex SHA-256 of an S3 object, streaming it in chunks
+  """
+  digest = hashlib.sha256()
+  body = s3.get_object(Bucket=bucketname, Key=bucketkey)['Body']
+  for chunk in iter(lambda: body.read(HASH_CHUNK), b""):
+    digest.update(chunk)
+  return digest.hexdigest()
+
+
+###################################################################
+#
+# prior_result:
+#
+# A file analyzed before, by any job on this shard, gets the same
+# result: looks for a completed job with the same content hash,
+# current or archived.
+#
+def prior_result(dbConn, content_hash, bucketkey):
+  """
+  Returns (valence, energy) of another completed job for the same
+  file content, or None
+  """
+  for table in ["jobs", "jobs_archive"]:
+    sql = "SELECT valence, energy FROM " + table + " WHERE content_hash = %s AND status = 'completed' AND datafilekey <> %s LIMIT 1"
+    row = datatier.retrieve_one_row(dbConn, sql, [content_hash, bucketkey])
+    if row != ():
+      return row
+  return None
@@ -1,4 +1,4 @@
-import requests
+import bootstrap
 
 def get_song_recommendations(valence, energy, genres, token):
     '''Get recommendations from Spotify using seed genres and a target valence and energy'''
@@ -14,7 +14,7 @@ def get_song_recommendations(valence, energy, genres, token):
     headers = {"Authorization": f"Bearer {token}"}
     
     print("**Sending request to get recommendations...**")
-    response = requests.get(url, headers=headers, params=params)
+    response = bootstrap.get_http_session().get(url, headers=headers, params=params)
     
     if response.status_code == 200:
         print("**Got recommendations, returning...**")
@@ -0,0 +1,125 @@
+#
+# conftest.py
+#
+# Fixtures for the handler tests, which run the final-project-*.py
+# handlers locally: the config file's rds shards are embedded
+# SQLite databases (create-db-sqlite.sql plus the migrations), and
+# its bucket lives in moto's in-process S3 stand-in, which also
+# serves HTTP requests to S3 URLs (e.g. a presigned PUT).
+#
+#   def test_...(musicapp, handler):
+#     upload = handler("upload")
+#     response = upload.lambda_handler(event, None)
+#
+# Requires the packages in requirements-dev.txt.
+#
+
+import importlib.util
+import pathlib
+import sys
+
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+sys.path.insert(0, str(ROOT))
+
+import bootstrap  # noqa: E402
+import datatier   # noqa: E402
+import migrate    # noqa: E402
+
+
+SHARDS = 2
+BUCKET = "musicapp-test"
+REGION = "us-east-1"
+
+
+def write_config(path, dbfiles):
+  sections = []
+
+  for (shard, dbfile) in enumerate(dbfiles):
+    sections.append("[rds-shard-%d]\n"
+                    "endpoint = sqlite:%s\n"
+                    "port_number = 0\n"
+                    "user_name = musicapp\n"
+                    "user_pwd = musicapp\n"
+                    "db_name = musicapp\n" % (shard, dbfile))
+
+  sections.append("[s3]\n"
+                  "bucket_name = %s\n"
+                  "region_name = %s\n" % (BUCKET, REGION))
+
+  sections.append("[s3readwrite]\n"
+                  "region_name = %s\n"
+                  "aws_access_key_id = testing\n"
+                  "aws_secret_access_key = testing\n" % REGION)
+
+  path.write_text("\n".join(sections))
+
+
+###################################################################
+#
+# musicapp:
+#
+# Sets up SHARDS SQLite shards, each with the 3 users of
+# create-db-sqlite.sql (80001 - 80003), and the bucket, and points
+# bootstrap at them; returns bootstrap's S3 client.
+#
+@pytest.fixture
+def musicapp(tmp_path, monkeypatch):
+  from moto import mock_aws
+
+  dbfiles = [tmp_path / ("shard-%d.db" % shard) for shard in range(SHARDS)]
+
+  for dbfile in dbfiles:
+    datatier.init_sqlite_db(str(dbfile), str(ROOT / "create-db-sqlite.sql"))
+
+    dbConn = datatier.get_dbConn("sqlite:" + str(dbfile), 0, "musicapp", "musicapp", "musicapp")
+    try:
+      migrate.migrate(dbConn, True)
+    finally:
+      dbConn.close()
+
+  config_file = tmp_path / "musicapp-config.ini"
+  write_config(config_file, dbfiles)
+
+  #
+  # a fresh container: bootstrap sets everything up again from
+  # this config file, with nothing cached from another test
+  #
+  monkeypatch.setattr(bootstrap, "CONFIG_FILE", str(config_file))
+  for name in ["_config", "_bucket", "_s3_client", "_shards", "_http_session"]:
+    monkeypatch.setattr(bootstrap, name, None)
+  monkeypatch.setattr(bootstrap, "_clients", {})
+
+  monkeypatch.setenv("AWS_SHARED_CREDENTIALS_FILE", str(config_file))
+  monkeypatch.setenv("AWS_DEFAULT_REGION", REGION)
+
+  datatier.invalidate_cache()
+
+  with mock_aws():
+    s3 = bootstrap.get_s3_client()
+    s3.create_bucket(Bucket=BUCKET)
+
+    yield s3
+
+  datatier.close_pools()
+
+
+###################################################################
+#
+# handler:
+#
+# Returns a function that loads a handler by name, e.g.
+# handler("upload-url") loads final-project-upload-url.py.
+#
+@pytest.fixture
+def handler():
+  def load(name):
+    path = ROOT / ("final-project-" + name + ".py")
+    spec = importlib.util.spec_from_file_location("final_project_" + name.replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+  return load
@@ -0,0 +1,114 @@
+#
+# test_sharding.py
+#
+# Users, and their jobs, live on shard userid % (number of shards);
+# the jobids handed to clients encode the shard, and the bucket
+# keys of uploads record it (see datatier.ShardMap). With the 2
+# shards of the musicapp fixture, user 80001 is on shard 1 and
+# 80002 on shard 0, and both shards number their jobs from 1001.
+#
+
+import base64
+import json
+
+import pytest
+
+import bootstrap
+import datatier
+
+
+@pytest.mark.parametrize("shard", [0, 1, 2, 17])
+@pytest.mark.parametrize("local_jobid", [1, 1001, datatier.SHARD_ID_SPAN - 1])
+def test_jobid_round_trip(shard, local_jobid):
+  jobid = datatier.encode_jobid(shard, local_jobid)
+
+  assert datatier.decode_jobid(jobid) == (shard, local_jobid)
+  assert datatier.decode_jobid(str(jobid)) == (shard, local_jobid)  # as in a URL path
+
+
+def test_shard_0_jobids_are_unchanged():
+  assert datatier.encode_jobid(0, 1001) == 1001
+
+
+@pytest.mark.parametrize("username", ["alice", "shard-2"])
+def test_bucketkey_shard(username):
+  shards = datatier.ShardMap([{}, {}, {}])
+
+  for shard in range(3):
+    bucketkey = "musicapp/" + shards.bucketkey_tag(shard) + username + "/song-1234.txt"
+    assert shards.shard_for_bucketkey(bucketkey) == shard
+
+
+def upload(handler, userid, data):
+  response = handler("upload").lambda_handler({
+    'userid': userid,
+    'body': json.dumps({'filename': 'song.txt', 'data': base64.b64encode(data).decode()})
+  }, None)
+
+  assert response['statusCode'] == 200
+  return json.loads(response['body'])
+
+
+def get_job(shard, local_jobid):
+  dbConn = bootstrap.get_shards().get_dbConn(shard)
+  try:
+    sql = "SELECT userid, status, datafilekey FROM jobs WHERE jobid = %s"
+    return datatier.retrieve_one_row(dbConn, sql, [local_jobid])
+  finally:
+    dbConn.close()
+
+
+def complete_job(shard, local_jobid, valence):
+  dbConn = bootstrap.get_shards().get_dbConn(shard)
+  try:
+    sql = "UPDATE jobs SET status = 'completed', valence = %s, energy = 0.5 WHERE jobid = %s"
+    datatier.perform_action(dbConn, sql, [valence, local_jobid])
+  finally:
+    dbConn.close()
+
+
+def test_upload_routes_to_the_users_shard(musicapp, handler):
+  jobid_1 = upload(handler, 80001, b"shard one")
+  jobid_0 = upload(handler, 80002, b"shard zero")
+
+  assert datatier.decode_jobid(jobid_1) == (1, 1001)
+  assert datatier.decode_jobid(jobid_0) == (0, 1001)
+
+  (userid, status, bucketkey) = get_job(1, 1001)
+  assert (userid, status) == (80001, "uploaded")
+  assert bucketkey.startswith("musicapp/shard-1/")
+  assert bootstrap.get_shards().shard_for_bucketkey(bucketkey) == 1
+
+  (userid, status, bucketkey) = get_job(0, 1001)
+  assert (userid, status) == (80002, "uploaded")
+  assert not bucketkey.startswith("musicapp/shard-")
+  assert bootstrap.get_shards().shard_for_bucketkey(bucketkey) == 0
+
+  # each upload is stored under its job's bucket key:
+  for shard in [0, 1]:
+    bucketkey = get_job(shard, 1001)[2]
+    musicapp.head_object(Bucket="musicapp-test", Key=bucketkey)
+
+
+def test_get_analysis_reads_the_jobs_shard(musicapp, handler):
+  jobid_1 = upload(handler, 80001, b"shard one")
+  jobid_0 = upload(handler, 80002, b"shard zero")
+
+  # the same local jobid on both shards, told apart by valence:
+  complete_job(1, 1001, 0.9)
+  complete_job(0, 1001, 0.1)
+
+  get_analysis = handler("get-analysis")
+
+  for (jobid, userid, valence) in [(jobid_1, 80001, 0.9), (jobid_0, 80002, 0.1)]:
+    response = get_analysis.lambda_handler({'jobid': str(jobid)}, None)
+    assert response['statusCode'] == 200
+
+    row = json.loads(response['body'])
+    assert (row[0], row[1], row[2]) == (int(jobid), userid, "completed")
+    assert row[5] == pytest.approx(valence)
+
+
+def test_get_analysis_unknown_shard(musicapp, handler):
+  response = handler("get-analysis").lambda_handler({'jobid': str(datatier.encode_jobid(5, 1001))}, None)
+  assert response['statusCode'] == 400
@@ -0,0 +1,93 @@
+#
+# test_upload_url.py
+#
+# The direct-to-S3 upload flow (final-project-upload-url.py): the
+# client asks for a presigned URL, PUTs the file to it, and the
+# job and the object are then in place for the analysis handlers.
+#
+
+import hashlib
+import json
+
+import requests
+
+import bootstrap
+import datatier
+
+from conftest import BUCKET
+
+
+def request_upload_url(upload_url, userid, body):
+  return upload_url.lambda_handler({'userid': userid, 'body': json.dumps(body)}, None)
+
+
+def get_job(jobid):
+  (shard, local_jobid) = datatier.decode_jobid(jobid)
+
+  dbConn = bootstrap.get_shards().get_dbConn(shard)
+  try:
+    sql = "SELECT userid, status, originaldatafile, datafilekey FROM jobs WHERE jobid = %s"
+    return datatier.retrieve_one_row(dbConn, sql, [local_jobid])
+  finally:
+    dbConn.close()
+
+
+def test_presigned_put(musicapp, handler):
+  upload_url = handler("upload-url")
+
+  data = b"What a wonderful day, I could dance all night!\n"
+
+  response = request_upload_url(upload_url, 80001, {'filename': 'happy.txt'})
+  assert response['statusCode'] == 200
+
+  body = json.loads(response['body'])
+
+  # SigV4, at the bucket's regional endpoint:
+  assert body['url'].startswith("https://" + BUCKET + ".s3.us-east-1.amazonaws.com/musicapp/")
+  assert "X-Amz-Algorithm=AWS4-HMAC-SHA256" in body['url']
+
+  put = requests.put(body['url'], data=data, headers=body['headers'])
+  assert put.status_code == 200
+
+  (userid, status, originaldatafile, bucketkey) = get_job(body['jobid'])
+  assert (userid, status, originaldatafile) == (80001, "uploaded", "happy.txt")
+
+  obj = musicapp.get_object(Bucket=BUCKET, Key=bucketkey)
+  assert obj['ContentType'] == "text/plain"
+  assert obj['Body'].read() == data
+
+
+def test_presigned_put_with_sha256(musicapp, handler):
+  upload_url = handler("upload-url")
+
+  data = b"\xff\xd8\xff\xe0 not much of a picture"
+  sha256 = hashlib.sha256(data).hexdigest()
+
+  response = request_upload_url(upload_url, 80002, {'filename': 'beach.jpg', 'sha256': sha256})
+  assert response['statusCode'] == 200
+
+  body = json.loads(response['body'])
+  assert "x-amz-checksum-sha256" in body['headers']
+
+  put = requests.put(body['url'], data=data, headers=body['headers'])
+  assert put.status_code == 200
+
+  (_, status, _, bucketkey) = get_job(body['jobid'])
+  assert status == "uploaded"
+
+  obj = musicapp.get_object(Bucket=BUCKET, Key=bucketkey)
+  assert obj['ContentType'] == "image/jpeg"
+  assert obj['Body'].read() == data
+
+
+def test_rejected_requests(musicapp, handler):
+  upload_url = handler("upload-url")
+
+  response = request_upload_url(upload_url, 80001, {'filename': 'notes.pdf'})
+  assert response['statusCode'] == 400
+
+  response = request_upload_url(upload_url, 80001, {'filename': 'happy.txt', 'sha256': "not a hash"})
+  assert response['statusCode'] == 400
+
+  response = request_upload_url(upload_url, 99999, {'filename': 'happy.txt'})
+  assert response['statusCode'] == 400